@@ -19,6 +19,22 @@ def readAlignmentString(str):
       sys.exit(1)
   return d
 
+def linkBitmask(links, lenF):
+  """
+  Return the set of links (f,e) as an integer bitmask over the f x e grid:
+  link (f,e) is bit e*lenF + f.
+  """
+  bits = 0
+  for (f, e) in links:
+    bits |= 1 << (e*lenF + f)
+  return bits
+
+def popcount(bits):
+  """
+  Number of set bits of integer bits.
+  """
+  return bin(bits).count('1')
+
 class Alignment(object):
   def __init__(self, str):
     self.score = 0
@@ -27,8 +43,10 @@ class Alignment(object):
     # Index links by column, or e index
     self.eLinks = defaultdict(list)
     # Index links also by row, or f index
-    self.numLinksInSpan = { }
     self.linksInSpan = { }
+    # linkCounts[e] = number of links with e index < e; see numLinksInSpan
+    self.linkCounts = None
+    self.bitmask = None
     self.read(str)
 
   def read(self, links_str, delim = '-'):
@@ -52,3 +70,27 @@ class Alignment(object):
         links += self.eLinks[e]
       self.linksInSpan[span] = links
     return links
+
+  def numLinksInSpan(self, span):
+    """
+    Return the number of links (f,e) s.t. span[0] <= e <= span[1], from a
+    prefix-sum table over e indices built on first use.
+    """
+    if self.linkCounts is None:
+      lenE = max([e for (f, e) in self.links_dict] or [-1]) + 1
+      counts = [0]*(lenE+1)
+      for e in xrange(lenE):
+        counts[e+1] = counts[e] + len(self.eLinks.get(e, ()))
+      self.linkCounts = counts
+    last = len(self.linkCounts) - 1
+    start = min(max(span[0], 0), last)
+    end = min(max(span[1]+1, start), last)
+    return self.linkCounts[end] - self.linkCounts[start]
+
+  def getBitmask(self, lenF):
+    """
+    Return all links as an integer bitmask (see linkBitmask).
+    """
+    if self.bitmask is None:
+      self.bitmask = linkBitmask([(f, e) for (f, e) in self.links_dict if f < lenF], lenF)
+    return self.bitmask
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+from heapq import heappush, heappushpop
+
+class Beam(object):
+  """
+  Bounded beam of the best items under one objective: the item attribute
+  'score', 'hope' or 'fear'.
+  Items sit in a heap of (value, tie, -number, item) tuples, worst first,
+  so ordering never goes through PartialGridAlignment.__cmp__. Items with
+  the same value are ranked by the item attribute tiebreak if given (the
+  preterminal cells use the model score), then by the order they were
+  added in, first added first.
+  """
+  def __init__(self, size, objective = 'score', tiebreak = None):
+    self.size = size
+    self.objective = objective
+    self.tiebreak = tiebreak
+    self.heap = [ ]
+    # Pruning statistics
+    self.numAdded = 0
+    self.numRejected = 0      # never made it into the beam
+    self.numEvicted = 0       # pushed out by a better item
+    self.numMarginPruned = 0  # dropped by the margin in finalize
+
+  def __len__(self):
+    return len(self.heap)
+
+  def add(self, item):
+    """
+    Add item if the beam isn't full, or if it beats the worst item.
+    Return True if item made it into the beam.
+    """
+    tie = 0
+    if self.tiebreak is not None:
+      tie = getattr(item, self.tiebreak)
+    entry = (getattr(item, self.objective), tie, -self.numAdded, item)
+    self.numAdded += 1
+    if len(self.heap) < self.size:
+      heappush(self.heap, entry)
+      return True
+    # Of two items with the same value, the one added first stays
+    if entry[0] > self.heap[0][0]:
+      heappushpop(self.heap, entry)
+      self.numEvicted += 1
+      return True
+    self.numRejected += 1
+    return False
+
+  def finalize(self, margin = None):
+    """
+    Return the items best-first, after a single sort. With margin set,
+    cut at the first item more than margin below the best; the best item
+    is always kept.
+    """
+    self.heap.sort(reverse=True)
+    items = [entry[-1] for entry in self.heap]
+    if margin is not None and len(items) > 0:
+      threshold = self.heap[0][0] - margin
+      for i in xrange(1, len(items)):
+        if self.heap[i][0] < threshold:
+          self.numMarginPruned += len(items) - i
+          items = items[:i]
+          break
+    return items
+
+  def stats(self):
+    """
+    Return the pruning statistics as a dictionary.
+    """
+    return {'added': self.numAdded,
+            'rejected': self.numRejected,
+            'evicted': self.numEvicted,
+            'marginPruned': self.numMarginPruned}
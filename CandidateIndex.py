@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+from collections import defaultdict
+
+def chunkWindows(f, e, a1, isPunctuation, slack = 0):
+  """
+  Split a sentence pair into chunks at high-confidence anchor points, and
+  return for each e index the window (lo, hi) of f indices its chunk may
+  link to.
+  Anchors are one-to-one links of the a1 (intersection) alignment and
+  identical punctuation tokens that occur equally often on both sides,
+  where the n-th occurrence in e is paired with the n-th occurrence in f.
+  We keep the longest monotone chain of anchors. The e words between two
+  anchors may link to the f words between (and including) those anchors;
+  an anchor word may link anywhere in the windows on either side of it.
+  Windows are widened by slack on both sides.
+  """
+  anchors = { }
+  fCount = defaultdict(int)
+  eCount = defaultdict(int)
+  for (fIndex, eIndex) in a1:
+    fCount[fIndex] += 1
+    eCount[eIndex] += 1
+  for (fIndex, eIndex) in a1:
+    if fCount[fIndex] == 1 and eCount[eIndex] == 1 and fIndex < len(f) and eIndex < len(e):
+      anchors[eIndex] = fIndex
+
+  fPositions = defaultdict(list)
+  ePositions = defaultdict(list)
+  for fIndex, fWord in enumerate(f):
+    if isPunctuation(fWord):
+      fPositions[fWord].append(fIndex)
+  for eIndex, eWord in enumerate(e):
+    if isPunctuation(eWord):
+      ePositions[eWord].append(eIndex)
+  for word in ePositions:
+    if len(ePositions[word]) == len(fPositions[word]):
+      for eIndex, fIndex in zip(ePositions[word], fPositions[word]):
+        anchors.setdefault(eIndex, fIndex)
+
+  # Longest chain of anchors increasing in both e and f
+  points = sorted(anchors.items())
+  length = [1]*len(points)
+  previous = [None]*len(points)
+  for i in xrange(len(points)):
+    for j in xrange(i):
+      if points[j][1] < points[i][1] and length[j] + 1 > length[i]:
+        length[i] = length[j] + 1
+        previous[i] = j
+  chain = [ ]
+  if len(points) > 0:
+    i = max(xrange(len(points)), key=lambda k: length[k])
+    while i is not None:
+      chain.append(points[i])
+      i = previous[i]
+    chain.reverse()
+
+  # Window boundaries between consecutive anchors
+  bounds = [(-1, 0)] + chain + [(len(e), len(f)-1)]
+  windows = { }
+  for k in xrange(len(bounds)-1):
+    (eStart, fStart) = bounds[k]
+    (eEnd, fEnd) = bounds[k+1]
+    for eIndex in xrange(max(0, eStart), min(len(e), eEnd+1)):
+      lo, hi = windows.get(eIndex, (fStart, fEnd))
+      windows[eIndex] = (min(lo, fStart), max(hi, fEnd))
+  for eIndex, (lo, hi) in windows.items():
+    windows[eIndex] = (max(0, lo - slack), min(len(f)-1, hi + slack))
+  return windows
+
+class CandidateIndex(object):
+  """
+  Per-sentence index of the f positions each e word may link to.
+  Preterminal search only scores links to candidate positions, and only
+  pairs candidates into two-link alignments if they obey the link gap
+  constraint. User-supplied forced and forbidden links are hard
+  constraints on top of that.
+  """
+  def __init__(self, f, e, pef, pfe, a1, a2, inverse,
+               fanout = None, band = 0, maxLinkGap = None, windows = None,
+               forced = None, forbidden = None):
+    """
+    f, e: sequences of words
+    pef, pfe: lexical translation tables, as read by nile.py
+    a1, a2, inverse: third-party link dictionaries {(f,e): True}
+    fanout: number of best f positions by lexical score kept for each
+            e word. This is also the guaranteed minimum number of
+            candidates per e word. None: keep every f position.
+    band: keep every f position within band of the diagonal
+    maxLinkGap: maximum distance between the f positions of a two-link
+                alignment. None: no constraint.
+    windows: if given, e index -> (lo, hi); e words only consider the f
+             positions lo..hi (see chunkWindows). Applied before fanout.
+    forced, forbidden: link dictionaries {(f,e): True} of hard constraints
+                       (see constrain)
+    """
+    self.lenF = len(f)
+    self.lenE = len(e)
+    self.maxLinkGap = maxLinkGap
+    self.fIndices = { }
+    self.forced = { }
+
+    if fanout is None or fanout >= self.lenF:
+      allIndices = range(self.lenF)
+      for eIndex in xrange(self.lenE):
+        if windows is not None:
+          lo, hi = windows[eIndex]
+          self.fIndices[eIndex] = range(lo, hi+1)
+        else:
+          self.fIndices[eIndex] = allIndices
+      self.constrain(forced, forbidden)
+      return
+
+    # f positions linked by third-party alignments
+    thirdParty = { }
+    for links in (a1, a2, inverse):
+      for (fIndex, eIndex) in links:
+        if fIndex < self.lenF and eIndex < self.lenE:
+          thirdParty.setdefault(eIndex, set()).add(fIndex)
+
+    for eIndex, eWord in enumerate(e):
+      diagonal = self.diagonal(eIndex)
+      candidates = thirdParty.get(eIndex, set())
+      lo, hi = 0, self.lenF-1
+      if windows is not None:
+        lo, hi = windows[eIndex]
+        candidates = set([fIndex for fIndex in candidates if lo <= fIndex <= hi])
+      # Rank f positions by lexical score, then by distance to the diagonal
+      ranked = [ ]
+      for fIndex in xrange(lo, hi+1):
+        fWord = f[fIndex]
+        distance = abs(fIndex - diagonal)
+        if distance <= band:
+          candidates.add(fIndex)
+        lexScore = (pef.get(fWord, {}).get(eWord, 0.0) +
+                    pfe.get(eWord, {}).get(fWord, 0.0))
+        ranked.append((-lexScore, distance, fIndex))
+      ranked.sort()
+      candidates.update([fIndex for (_, _, fIndex) in ranked[:fanout]])
+      self.fIndices[eIndex] = sorted(candidates)
+    self.constrain(forced, forbidden)
+
+  def constrain(self, forced, forbidden):
+    """
+    Apply hard link constraints to the candidate lists.
+    A forbidden link is never a candidate. A forced link always is, and
+    its f word may not link to any e word it isn't forced to. An e word
+    with more than two forced links may only link to those. Forced links
+    take precedence over forbidden ones.
+    """
+    if not forced and not forbidden:
+      return
+    forbidden = forbidden or { }
+    forced = forced or { }
+    # f index -> set of e indices it is forced to
+    forcedE = { }
+    for (fIndex, eIndex) in forced:
+      if fIndex < self.lenF and eIndex < self.lenE:
+        self.forced.setdefault(eIndex, set()).add(fIndex)
+        forcedE.setdefault(fIndex, set()).add(eIndex)
+    for eIndex in xrange(self.lenE):
+      self.fIndices[eIndex] = sorted(set([fIndex for fIndex in self.fIndices[eIndex]
+                                          if (fIndex, eIndex) not in forbidden
+                                          and eIndex in forcedE.get(fIndex, (eIndex,))]) |
+                                     self.forced.get(eIndex, set()))
+      if len(self.forced.get(eIndex, ())) > 2:
+        self.fIndices[eIndex] = sorted(self.forced[eIndex])
+
+  def diagonal(self, eIndex):
+    """
+    Return the f position on the diagonal of the alignment matrix at eIndex.
+    """
+    if self.lenE <= 1:
+      return 0.0
+    return eIndex * (self.lenF - 1) / float(self.lenE - 1)
+
+  def candidates(self, eIndex):
+    """
+    Return the candidate f positions for eIndex, in increasing order.
+    """
+    return self.fIndices[eIndex]
+
+  def required(self, eIndex):
+    """
+    Return the set of f positions that every alignment of eIndex must link
+    to. We only build alignments of up to two links per e word, so an e
+    word with more forced links must link to some of them instead.
+    """
+    forced = self.forced.get(eIndex, None)
+    if forced is None or len(forced) > 2:
+      return set()
+    return forced
+
+  def allowLinks(self, eIndex, fIndices):
+    """
+    Do the links from eIndex to fIndices satisfy the forced links of eIndex?
+    An e word with forced links can't be unaligned.
+    """
+    if eIndex not in self.forced:
+      return True
+    if len(fIndices) == 0:
+      return False
+    return self.required(eIndex).issubset(fIndices)
+
+  def allowPair(self, fIndex_a, fIndex_b, eIndex = None):
+    """
+    Can fIndex_a and fIndex_b both link to the same e word?
+    A pair of forced links of eIndex is always allowed.
+    """
+    if self.maxLinkGap is None:
+      return True
+    if eIndex is not None:
+      required = self.required(eIndex)
+      if fIndex_a in required and fIndex_b in required:
+        return True
+    return abs(fIndex_b - fIndex_a) <= self.maxLinkGap
@@ -5,7 +5,7 @@
 #########################################################
 
 from collections import defaultdict
-from NLPTreeHelper import containsSpan
+from NLPTreeHelper import containsSpan, unbinarized
 import sys
 import hminghkm as minghkm
 from pyglog import *
@@ -515,95 +515,112 @@ class NonlocalFeatures:
     clusters as we combine two treenode spans.
     """
     name = self.ff_nonlocal_crossb.func_name
-    values = {}
     try:
-      edge1 = childEdges[0]
-      edge2 = childEdges[1]
-      edge1_maxF = edge1.boundingBox[1][0]
-      edge2_maxF = edge2.boundingBox[1][0]
-      edge2_minF = edge2.boundingBox[0][0]
-      edge1_minF = edge1.boundingBox[0][0]
-
-      # Case 0: Equal bounding boxes
-      # [    ] [    ]
-      # [    ] [    ]
-      if edge1_maxF == edge2_maxF and edge1_minF == edge2_minF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'0___'+value] = 1
-      # Case 1 (monotonic)
-      # [    ]
-      # [    ]
-      #        [    ]
-      #        [    ]
-      elif edge1_maxF < edge2_minF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'1___'+value] = 1
-      # Case 2 (reordered)
-      #        [    ]
-      #        [    ]
-      # [    ]
-      # [    ]
-      elif edge1_minF > edge2_maxF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'2___'+value] = 1
-      # Case 3
-      # [    ]
-      # [    ] [    ]
-      #        [    ]
-      elif edge1_maxF >= edge2_minF and edge1_maxF < edge2_maxF and edge1_minF < edge2_minF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'3___'+value] = 1
-      # Case 4
-      #        [    ]
-      # [    ] [    ]
-      # [    ] [    ]
-      # [    ]
-
-      elif edge1_minF >= edge2_minF and edge1_minF < edge2_maxF and edge1_maxF > edge2_maxF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'4___'+value] = 1
-      # Case 5 (1 shares top of 2)
-      # [    ] [    ]
-      #        [    ]
-      elif edge1_minF == edge2_minF and edge1_maxF < edge2_maxF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'5___'+value] = 1
-      # Case 6 (1 shares bot of 2)
-      #        [    ]
-      # [    ] [    ]
-      elif edge1_maxF == edge2_maxF and edge1_minF > edge2_minF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'6___'+value] = 1
-      # Case 7 (2 shares top of 1; same as 5 but diff bracketing)
-      # [    ] [    ]
-      # [    ]
-      elif edge2_minF == edge1_minF and edge2_maxF < edge1_maxF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'7___'+value] = 1
-      # Case 8 (2 shares bot of 1; same as 6 but diff bracketing)
-      # [    ]
-      # [    ] [    ]
-      elif edge2_maxF == edge1_maxF and edge2_minF > edge1_minF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'8___'+value] = 1
-      # Case 9 (1 wholly contained in 2)
-      #        [    ]
-      # [    ] [    ]
-      #        [    ]
-      elif edge1_minF > edge2_minF and edge1_maxF < edge2_maxF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'9___'+value] = 1
-      # Case 10 (2 wholly contained in 1)
-      # [    ]
-      # [    ] [    ]
-      # [    ]
-      elif edge2_minF > edge1_minF and edge2_maxF < edge1_maxF:
-          value = "%s(%s,%s)" %(treeNode.data,treeNode.children[0].data,treeNode.children[1].data)
-          values[name+'10___'+value] = 1
-      # else: dump links here to find out what cases we missed, if any
+      children = self.realChildren(treeNode, edge)
+      case = self.crossbCase(children[0][1], children[1][1])
+      if case is None:
+        return {}
+      value = "%s(%s,%s)" %(treeNode.data,children[0][0].data,children[1][0].data)
     except:
       return {}
-    return values
+    return {name+str(case)+'___'+value: 1}
+
+  def realChildren(self, treeNode, edge=None):
+    """
+    Return (child, childEdge) for the children of treeNode in the tree
+    before binarization: virtual children are replaced by their own
+    children, and their edges by the edges they were built from. Without
+    edge, childEdge is None.
+    """
+    children = [ ]
+    for c, child in enumerate(treeNode.children):
+      if edge is None or edge.children is None:
+        childEdge = None
+      else:
+        childEdge = edge.children[c]
+      if child.virtual:
+        children += self.realChildren(child, childEdge)
+      else:
+        children.append((child, childEdge))
+    return children
+
+  def crossbCase(self, edge1, edge2):
+    """
+    Return the configuration (0-10) of the bounding boxes of edge1 and
+    edge2 for ff_nonlocal_crossb, or None if none applies.
+    """
+    edge1_maxF = edge1.boundingBox[1][0]
+    edge2_maxF = edge2.boundingBox[1][0]
+    edge2_minF = edge2.boundingBox[0][0]
+    edge1_minF = edge1.boundingBox[0][0]
+
+    # Case 0: Equal bounding boxes
+    # [    ] [    ]
+    # [    ] [    ]
+    if edge1_maxF == edge2_maxF and edge1_minF == edge2_minF:
+      return 0
+    # Case 1 (monotonic)
+    # [    ]
+    # [    ]
+    #        [    ]
+    #        [    ]
+    elif edge1_maxF < edge2_minF:
+      return 1
+    # Case 2 (reordered)
+    #        [    ]
+    #        [    ]
+    # [    ]
+    # [    ]
+    elif edge1_minF > edge2_maxF:
+      return 2
+    # Case 3
+    # [    ]
+    # [    ] [    ]
+    #        [    ]
+    elif edge1_maxF >= edge2_minF and edge1_maxF < edge2_maxF and edge1_minF < edge2_minF:
+      return 3
+    # Case 4
+    #        [    ]
+    # [    ] [    ]
+    # [    ] [    ]
+    # [    ]
+
+    elif edge1_minF >= edge2_minF and edge1_minF < edge2_maxF and edge1_maxF > edge2_maxF:
+      return 4
+    # Case 5 (1 shares top of 2)
+    # [    ] [    ]
+    #        [    ]
+    elif edge1_minF == edge2_minF and edge1_maxF < edge2_maxF:
+      return 5
+    # Case 6 (1 shares bot of 2)
+    #        [    ]
+    # [    ] [    ]
+    elif edge1_maxF == edge2_maxF and edge1_minF > edge2_minF:
+      return 6
+    # Case 7 (2 shares top of 1; same as 5 but diff bracketing)
+    # [    ] [    ]
+    # [    ]
+    elif edge2_minF == edge1_minF and edge2_maxF < edge1_maxF:
+      return 7
+    # Case 8 (2 shares bot of 1; same as 6 but diff bracketing)
+    # [    ]
+    # [    ] [    ]
+    elif edge2_maxF == edge1_maxF and edge2_minF > edge1_minF:
+      return 8
+    # Case 9 (1 wholly contained in 2)
+    #        [    ]
+    # [    ] [    ]
+    #        [    ]
+    elif edge1_minF > edge2_minF and edge1_maxF < edge2_maxF:
+      return 9
+    # Case 10 (2 wholly contained in 1)
+    # [    ]
+    # [    ] [    ]
+    # [    ]
+    elif edge2_minF > edge1_minF and edge2_maxF < edge1_maxF:
+      return 10
+    # else: dump links here to find out what cases we missed, if any
+    return None
 
   def ff_nonlocal_horizGridDistance(self, info,  treeNode, edge, links, srcSpan, tgtSpan, linkedToWords, childEdges, diagValues, treeDistValues):
     """
@@ -640,9 +657,9 @@ class NonlocalFeatures:
     name = self.ff_nonlocal_isPuncAndHasMoreThanOneLink.func_name
 
     val = 0.0
+    fPunc = info['fPunc']
     for fIndex in linkedToWords:
-      fWord = info['f'][fIndex]
-      if self.isPunctuation(fWord) and len(linkedToWords[fIndex]) > 1:
+      if fPunc[fIndex] and len(linkedToWords[fIndex]) > 1:
         val += 1.0
     return {name: val}
 
@@ -652,19 +669,23 @@ class NonlocalFeatures:
     Fire Source-target coordination features.
     From (Riesa et al., 2011) Section 3.2.1.
     """
-    name = self.ff_nonlocal_tgtTag_srcTag.func_name
-
     if treeNode.data == '_XXX_':
       return {}
     if info['ftree'] is None:
       return {}
     if len(info['ftree'].terminals) == 0:
       return {}
+    return self.tagFeatures(info, treeNode.data, edge)
 
-    tgtTag = treeNode.data
+  def tagFeatures(self, info, tgtTag, edge):
+    """
+    Source-target coordination features of edge, whose e tree node has
+    label tgtTag.
+    """
+    name = self.ff_nonlocal_tgtTag_srcTag.func_name
     srcTag = ""
     # Account for the null alignment case
-    if len(links) == 0:
+    if edge.numLinks == 0:
       value = "%s:%s" % (tgtTag, self.null_token)
       return {name+'___'+value: 1}
 
@@ -697,13 +718,17 @@ class NonlocalFeatures:
     """
     Fire features for every translation rule extracted at the current node.
     """
-    name = self.ff_nonlocal_hminghkm.func_name
     if len(links) == 0:
       return {}
-    features = defaultdict(int)
+    return self.ruleFeatures(info, treeNode, links, treeNode.span_start(), treeNode.span_end())
 
-    start_span = treeNode.span_start()
-    end_span = treeNode.span_end()
+  def ruleFeatures(self, info, treeNode, links, start_span, end_span):
+    """
+    Translation rule features for links at treeNode, which spans the e
+    words start_span..end_span.
+    """
+    name = self.ff_nonlocal_hminghkm.func_name
+    features = defaultdict(int)
     l = [ ]
     minf = len(info['f'])
     maxf = 0
@@ -720,7 +745,7 @@ class NonlocalFeatures:
     links_subset = [(link[0]-minf, link[1]) for link in l]
 
     if len(links_subset) > 0:
-      for rule in minghkm.extract(fsubset, treeNode, links_subset, start_span, hierarchical=True):
+      for rule in minghkm.extract(fsubset, unbinarized(treeNode), links_subset, start_span, hierarchical=True):
         try:
           ruleRoot = rule.e.data
         except:
@@ -774,7 +799,8 @@ class NonlocalFeatures:
               # compute distance in pairs: if list = [1,2,3], compute dist(1,2), dist(2,3)
               # if list has length n, we will have n-1 distance computations
 
-        linkedToWords_copy[fIndex].sort()
+        # Sort a copy; the lists may be shared with other edges
+        linkedToWords_copy[fIndex] = sorted(linkedToWords_copy[fIndex])
         listlength = len(linkedToWords_copy[fIndex])
         for i in xrange(listlength-1):
           # eIndex1 and eIndex2 will always be the smallest, and second-smallest indices, respectively.
@@ -841,6 +867,7 @@ class NonlocalFeatures:
     # Compute number of hops from node 1 to the YCA and from node2 to the YCA
     # Keep track of single-child non-perterminal nodes along each path and subtract the number
     # we encounter from the total hops, e.g. in NPC(... NPB(NN(dog))) NPB is effectively skipped.
+    # Nodes introduced by binarization are skipped as well.
 
     while (node1 is not node2):
       node1depth = node1.depth()
@@ -850,19 +877,19 @@ class NonlocalFeatures:
         node2 = node2.getParent()
         units1 += 1
         units2 += 1
-        if len(node1.children) == 1:
+        if len(node1.children) == 1 or node1.virtual:
           skips1 += 1
-        if len(node2.children) == 1:
+        if len(node2.children) == 1 or node2.virtual:
           skips2 += 1
       elif node1depth < node2depth:
         node1 = node1.getParent()
         units1 += 1
-        if len(node1.children) == 1:
+        if len(node1.children) == 1 or node1.virtual:
           skips1 += 1
       elif node1depth > node2depth:
         node2 = node2.getParent()
         units2 += 1
-        if len(node2.children) == 1:
+        if len(node2.children) == 1 or node2.virtual:
           skips2 += 1
 
     # Both node1 and node2 both point to the YCA at this point.
@@ -907,6 +934,220 @@ class NonlocalFeatures:
     distance *= -1.0
     return distance
 
+  ################################################################################
+  # Upper bounds
+  # ub_nonlocal_X bounds the weighted contribution sum(weights[name]*value)
+  # of the features ff_nonlocal_X fires at treeNode, for any edge over srcSpan.
+  # It only depends on the node, so it is computed once per node.
+  # maxWeights is the table built by maxWeights().
+  ################################################################################
+  def maxWeights(self, weights):
+    """
+    Return the largest positive weight of each nonlocal feature family
+    (the part of the name before '___'), and of each (family, label) for
+    rule features, whose names start with the label of the node they fire at.
+    """
+    ruleFamily = self.ff_nonlocal_hminghkm.func_name
+    maxima = defaultdict(float)
+    for name, w in weights.iteritems():
+      if w <= 0 or not name.startswith('ff_nonlocal_'):
+        continue
+      parts = name.split('___', 1)
+      keys = [parts[0]]
+      if len(parts) == 2 and parts[0] == ruleFamily:
+        keys.append((ruleFamily, parts[1][1:].split('_')[0]))
+      for key in keys:
+        if w > maxima[key]:
+          maxima[key] = w
+    return maxima
+
+  def ub_nonlocal_dummy(self, info, treeNode, srcSpan, weights, maxWeights):
+    return 0.0
+
+  def ub_nonlocal_horizGridDistance(self, info, treeNode, srcSpan, weights, maxWeights):
+    """
+    Each of at most 2n link pairs adds at most 1.
+    """
+    name = self.ff_nonlocal_horizGridDistance.func_name + '_nb'
+    return max(0.0, weights[name]) * 2 * (srcSpan[1] - srcSpan[0] + 1)
+
+  def ub_nonlocal_hminghkm(self, info, treeNode, srcSpan, weights, maxWeights):
+    """
+    Hierarchical extraction yields at most the one rule rooted at treeNode.
+    """
+    name = self.ff_nonlocal_hminghkm.func_name
+    if '_' in treeNode.data or ' ' in treeNode.data:
+      return maxWeights.get(name, 0.0)
+    return maxWeights.get((name, treeNode.data), 0.0)
+
+  ################################################################################
+  # Per-edge bounds
+  # delta_nonlocal_X bounds the change in score when ff_nonlocal_X fires for
+  # edge at treeNode: the weighted values it fires, minus the weighted
+  # values the children had for the same features, which they overwrite.
+  # edge is not scored yet: it only has its children, links count and
+  # bounding box. Templates that can look at the children get one instead of
+  # ub_nonlocal_X; most compute the change exactly. Templates with neither
+  # disable bound pruning.
+  ################################################################################
+  def overwriteDelta(self, edge, values, weights):
+    """
+    Change in score when the nonzero values in values overwrite those the
+    children of edge have for the same features.
+    """
+    delta = 0.0
+    for name, value in values.iteritems():
+      if value != 0:
+        childValue = sum([e.scoreVector_nonlocal[name] for e in edge.children])
+        delta += (value - childValue)*weights[name]
+    return delta
+
+  def joinDelta(self, func, join, info, treeNode, edge, sharedF, tgtSpan, weights, treeDistValues):
+    """
+    Exact change in score for a template with an incremental version.
+    """
+    key = func.func_name
+    childStates = [e.nonlocalState and e.nonlocalState.get(key, None) for e in edge.children]
+    state, values = join(info, treeNode, edge, childStates, sharedF, tgtSpan, treeDistValues)
+    return self.overwriteDelta(edge, values, weights)
+
+  def delta_nonlocal_crossb(self, info, treeNode, edge, sharedF, tgtSpan, weights, treeDistValues):
+    values = self.ff_nonlocal_crossb(info, treeNode, edge, None, treeNode.span, tgtSpan, None, edge.children, None, treeDistValues)
+    return self.overwriteDelta(edge, values, weights)
+
+  def delta_nonlocal_tgtTag_srcTag(self, info, treeNode, edge, sharedF, tgtSpan, weights, treeDistValues):
+    values = self.ff_nonlocal_tgtTag_srcTag(info, treeNode, edge, None, treeNode.span, tgtSpan, None, edge.children, None, treeDistValues)
+    return self.overwriteDelta(edge, values, weights)
+
+  def delta_nonlocal_isPuncAndHasMoreThanOneLink(self, info, treeNode, edge, sharedF, tgtSpan, weights, treeDistValues):
+    return self.joinDelta(self.ff_nonlocal_isPuncAndHasMoreThanOneLink, self.join_nonlocal_isPuncAndHasMoreThanOneLink,
+                          info, treeNode, edge, sharedF, tgtSpan, weights, treeDistValues)
+
+  def delta_nonlocal_treeDistance1(self, info, treeNode, edge, sharedF, tgtSpan, weights, treeDistValues):
+    return self.joinDelta(self.ff_nonlocal_treeDistance1, self.join_nonlocal_treeDistance1,
+                          info, treeNode, edge, sharedF, tgtSpan, weights, treeDistValues)
+
+  def delta_nonlocal_sameWordLinks(self, info, treeNode, edge, sharedF, tgtSpan, weights, treeDistValues):
+    """
+    Not exact. Each f word adds at most one less than its number of links,
+    so the penalty is at most the number of links minus the number of
+    linked f words.
+    """
+    name = self.ff_nonlocal_sameWordLinks.func_name
+    if edge.numLinks < 2:
+      return 0.0
+    numLinkedF = sum([len(e.fOrder) for e in edge.children])
+    for fIndex in sharedF:
+      numLinkedF -= len([e for e in edge.children if fIndex in e.linkedIndices]) - 1
+    maxValue = edge.numLinks - numLinkedF
+    if maxValue <= 0:
+      return 0.0
+    childValue = sum([e.scoreVector_nonlocal[name] for e in edge.children])
+    w = weights[name]
+    if w >= 0:
+      return max(0.0, (maxValue - childValue)*w)
+    return max(0.0, -childValue*w)
+
+  ################################################################################
+  # Batched templates
+  # batch_nonlocal_X returns, for each edge in edges, the features
+  # ff_nonlocal_X fires for it. All edges are combined at treeNode, so work
+  # that only depends on the node is done once. tgtSpans and
+  # linkedToWordsList hold the tgtSpan and linkedToWords of each edge.
+  # Templates without a batched version are called once per edge.
+  ################################################################################
+  def batch_nonlocal_crossb(self, info, treeNode, edges, srcSpan, tgtSpans, linkedToWordsList, diagValues, treeDistValues):
+    name = self.ff_nonlocal_crossb.func_name
+    try:
+      children = self.realChildren(treeNode)
+      value = "%s(%s,%s)" %(treeNode.data,children[0][0].data,children[1][0].data)
+    except:
+      return [{} for edge in edges]
+    names = [name+str(case)+'___'+value for case in xrange(11)]
+    values = [ ]
+    for edge in edges:
+      try:
+        children = self.realChildren(treeNode, edge)
+        case = self.crossbCase(children[0][1], children[1][1])
+      except:
+        case = None
+      if case is None:
+        values.append({})
+      else:
+        values.append({names[case]: 1})
+    return values
+
+  def batch_nonlocal_tgtTag_srcTag(self, info, treeNode, edges, srcSpan, tgtSpans, linkedToWordsList, diagValues, treeDistValues):
+    if treeNode.data == '_XXX_' or info['ftree'] is None or len(info['ftree'].terminals) == 0:
+      return [{} for edge in edges]
+    return [self.tagFeatures(info, treeNode.data, edge) for edge in edges]
+
+  def batch_nonlocal_hminghkm(self, info, treeNode, edges, srcSpan, tgtSpans, linkedToWordsList, diagValues, treeDistValues):
+    start_span = treeNode.span_start()
+    end_span = treeNode.span_end()
+    values = [ ]
+    for edge in edges:
+      if edge.numLinks == 0:
+        values.append({})
+      else:
+        values.append(self.ruleFeatures(info, treeNode, edge.links, start_span, end_span))
+    return values
+
+  ################################################################################
+  # Incremental templates
+  # join_nonlocal_X computes the features of ff_nonlocal_X for edge from a
+  # summary, or state, of each child, looking only at what joining the
+  # children adds. It returns (state, features) for edge; the state is kept
+  # on the edge for its parents. childStates holds the children's states,
+  # None for preterminal items. sharedF lists the f indices linked from
+  # more than one child, and edge.children[i].linkedIndices[fIndex] the e
+  # indices child i links fIndex to, in increasing order. Children cover
+  # consecutive e spans, left to right.
+  # States are kept at every node, also where no features fire.
+  ################################################################################
+  def join_nonlocal_isPuncAndHasMoreThanOneLink(self, info, treeNode, edge, childStates, sharedF, tgtSpan, treeDistValues):
+    """
+    State: the number of punctuation f words with more than one link.
+    Joining only adds shared f words that had one link in each child.
+    """
+    name = self.ff_nonlocal_isPuncAndHasMoreThanOneLink.func_name
+    val = sum([state for state in childStates if state is not None])
+    fPunc = info['fPunc']
+    for fIndex in sharedF:
+      if fPunc[fIndex]:
+        val += 1
+        for child in edge.children:
+          if len(child.linkedIndices.get(fIndex, ())) > 1:
+            val -= 1
+    return val, {name: float(val)}
+
+  def join_nonlocal_treeDistance1(self, info, treeNode, edge, childStates, sharedF, tgtSpan, treeDistValues):
+    """
+    State: the sum of tree distances between consecutive e words linked to
+    the same f word. Joining only adds the pairs across child boundaries.
+    """
+    name = self.ff_nonlocal_treeDistance1.func_name + '_nb'
+    dist = sum([state for state in childStates if state is not None], 0.0)
+    for fIndex in sharedF:
+      eIndex1 = None
+      for child in edge.children:
+        eIndices = child.linkedIndices.get(fIndex, None)
+        if eIndices is None:
+          continue
+        if eIndex1 is not None:
+          eIndex2 = eIndices[0]
+          val = treeDistValues.get((eIndex1, eIndex2), None)
+          if val is None:
+            node1 = info['etree'].getTerminal(eIndex1).getParent()
+            node2 = info['etree'].getTerminal(eIndex2).getParent()
+            val = self.treeDistance1(info['etree'], node1, node2)
+            treeDistValues[(eIndex1, eIndex2)] = val
+          dist += val
+        eIndex1 = eIndices[-1]
+    if tgtSpan is None or tgtSpan[1] == tgtSpan[0]:
+      return dist, {name: 0.}
+    return dist, {name: dist / (tgtSpan[1] - tgtSpan[0])}
+
   def isPunctuation(self, string):
     """
     Return True if string is one of  , . ! ? ' " ( ) : ; - @ etc.
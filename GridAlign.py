@@ -22,18 +22,142 @@
 #########################################################
 
 import sys
+import cPickle
+import math
+import multiprocessing
+import time
 from itertools import izip
 from operator import attrgetter
-from heapq import heappush, heapify, heappop, heappushpop
+from heapq import heappush, heapify, heappop, heapreplace
 from collections import defaultdict
 
 from TerminalNode import TerminalNode
-from Alignment import readAlignmentString
+from Alignment import readAlignmentString, linkBitmask, popcount
+from CandidateIndex import CandidateIndex, chunkWindows
 from PartialGridAlignment import PartialGridAlignment
+from Beam import Beam
 from NLPTreeHelper import *
 import Fmeasure
 import pysvector as svector
 import hminghkm
+from pyglog import *
+
+# Traversal schedules of training trees, keyed by tree string.
+# Compiled in the first epoch, reused in later ones.
+scheduleCache = { }
+# Largest nonlocal feature weights, for the weight vector last seen;
+# see maxNonlocalWeights()
+boundCache = { }
+
+def keepBest(heap, value, size):
+  """
+  Keep the size largest values pushed into the min-heap heap.
+  """
+  if len(heap) < size:
+    heappush(heap, value)
+  elif value > heap[0]:
+    heapreplace(heap, value)
+
+class BudgetExceeded(Exception):
+  """
+  Raised when the search for a sentence runs out of time or edges.
+  """
+  pass
+
+# What the workers of a SubtreePool share: the feature objects, their
+# tables and the flags. Workers are forked, so they see it without
+# pickling it.
+subtreeShared = None
+# The job a worker last built a model for, and that model
+subtreeJob = (None, None)
+
+class SubtreePool(object):
+  """
+  Process pool that aligns disjoint subtrees of long sentences; see
+  Model.parallel_visit. Create it once per process, after the feature
+  objects and tables are loaded, and give it to every model. For each
+  sentence, a worker builds its own copy of the model from the inputs of
+  the original.
+  """
+  def __init__(self, numProcs, LOCAL_FEATURES, NONLOCAL_FEATURES, pef, pfe, FLAGS):
+    global subtreeShared
+    subtreeShared = {'LOCAL_FEATURES': LOCAL_FEATURES,
+                     'NONLOCAL_FEATURES': NONLOCAL_FEATURES,
+                     'pef': pef,
+                     'pfe': pfe,
+                     'FLAGS': FLAGS}
+    self.numProcs = numProcs
+    self.numJobs = 0
+    self.pool = multiprocessing.Pool(numProcs)
+
+  def alignSubtrees(self, model, roots, firstCell, budgets):
+    """
+    Align the subtrees of model whose roots are the cells at positions
+    roots of its schedule, and return what alignSubtree returns for each.
+    firstCell[i] is where the subtree rooted at cell i begins, and
+    budgets[i] is its edge budget, or None.
+    The spec of the model is pickled once, and each worker builds its copy
+    for the first of the subtrees it gets.
+    """
+    self.numJobs += 1
+    spec = cPickle.dumps(model.subtreeSpec(), cPickle.HIGHEST_PROTOCOL)
+    tasks = [ ]
+    for i in roots:
+      budget = None
+      if budgets is not None:
+        budget = budgets[i]
+      tasks.append((self.numJobs, spec, firstCell[i], i, budget))
+    return self.pool.map(alignSubtree, tasks, chunksize=1)
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
+
+def alignSubtree(task):
+  """
+  Pool worker: align the subtree of the cells first..i of the schedule of
+  the model of job, within an edge budget of budget, and return the cells
+  of cell i and the number of edges created.
+  """
+  global subtreeJob
+  job, spec, first, i, budget = task
+  if subtreeJob[0] != job:
+    # Let go of the model of the last job before building the next
+    subtreeJob = (None, None)
+    subtreeJob = (job, subtreeModel(cPickle.loads(spec)))
+  model = subtreeJob[1]
+  model.numEdges = 0
+  model.oracleFixed = True
+  model.EDGE_BUDGET = budget
+  try:
+    for currentNode in model.schedule[first:i+1]:
+      if currentNode.cellChildren is None:
+        model.terminal_operation(currentNode.eIndex, currentNode)
+      else:
+        model.nonterminal_operation_cube(currentNode)
+  except BudgetExceeded, reason:
+    raise BudgetExceeded("%s in a subtree" %(reason))
+  node = model.schedule[i]
+  return (node.partialAlignments, node.partialAlignments_hope,
+          node.partialAlignments_fear, node.oracle, model.oracleFixed,
+          model.numEdges)
+
+def subtreeModel(spec):
+  """
+  Build the model described by spec (see Model.subtreeSpec) in a worker
+  of a SubtreePool, ready to fill cells.
+  """
+  inputs, weights, state = spec
+  model = Model(weights = weights,
+                LOCAL_FEATURES = subtreeShared['LOCAL_FEATURES'],
+                NONLOCAL_FEATURES = subtreeShared['NONLOCAL_FEATURES'],
+                FLAGS = subtreeShared['FLAGS'], **inputs)
+  model.pef = subtreeShared['pef']
+  model.pfe = subtreeShared['pfe']
+  for name, value in state.iteritems():
+    setattr(model, name, value)
+  model.setupCandidates()
+  return model
 
 class Model(object):
   """
@@ -42,7 +166,8 @@ class Model(object):
   def __init__(self, f = None, e = None, etree = None, ftree = None,
                id = "no-id-given", weights = None, a1 = None, a2 = None,
                inverse = None, DECODING=False,
-               LOCAL_FEATURES = None, NONLOCAL_FEATURES = None, FLAGS=None):
+               LOCAL_FEATURES = None, NONLOCAL_FEATURES = None, FLAGS=None,
+               constraints = None):
 
     ################################################
     # Constants and Flags
@@ -52,20 +177,74 @@ class Model(object):
       sys.exit(1)
 
     self.FLAGS = FLAGS
+    # What workers of a SubtreePool need to build this model again
+    self.inputs = {'f': f, 'e': e, 'etree': etree, 'ftree': ftree, 'id': id,
+                   'a1': a1, 'a2': a2, 'inverse': inverse,
+                   'DECODING': DECODING, 'constraints': constraints}
 
     self.LOCAL_FEATURES = LOCAL_FEATURES
     self.NONLOCAL_FEATURES = NONLOCAL_FEATURES
     self.LANG = FLAGS.langpair
+    # Maximum distance between the f positions of a two-link alignment.
+    # Arabic/English defaults to adjacent f words only.
+    self.MAX_LINK_GAP = FLAGS.maxlinkgap
+    if self.MAX_LINK_GAP is None and self.LANG == "ar_en":
+      self.MAX_LINK_GAP = 1
     if FLAGS.init_k is not None:
       self.BEAM_SIZE = FLAGS.init_k
     else:
       self.BEAM_SIZE = FLAGS.k
     self.NT_BEAM = FLAGS.k
+    # Number of root alignments to output; see align
+    self.NBEST = None
+    if DECODING and FLAGS.align:
+      self.NBEST = FLAGS.nbest
+    # Beam size per word of span for nonterminals, capped by NT_BEAM
+    self.K_PER_WORD = FLAGS.kperword
+    # Relative beam: drop items more than BEAM_MARGIN below the cell best
+    self.BEAM_MARGIN = FLAGS.beam_margin
     self.COMPUTE_HOPE = False
     self.COMPUTE_1BEST = False
     self.COMPUTE_FEAR = False
     self.COMPUTE_ORACLE = False
     self.DO_RESCORE = FLAGS.rescore
+    self.LAZY_CUBE = FLAGS.lazy
+    # Keep links as integer bitmasks, for fast fscore and comparison
+    self.LINK_BITS = FLAGS.linkbits
+    # Cut child cells down to their best item once the parent cell is built.
+    # Cube growing and the local-only decoder need them until the end.
+    self.RELEASE_BEAMS = not FLAGS.keepbeams
+    # Per-sentence search budget, in seconds and in created edges
+    self.TIME_BUDGET = FLAGS.timebudget
+    self.EDGE_BUDGET = FLAGS.edgebudget
+    self.deadline = None
+    self.numEdges = 0
+    # Beam sizes of the first search; see startBudget
+    self.fullBeamSizes = None
+    # Edge budget of each subtree aligned by the process pool
+    self.subtreeBudgets = None
+    self.fallbackLevel = 0
+    # Pruning statistics of all beams, summed over the sentence
+    self.beamStats = defaultdict(int)
+    # Align large subtrees of long sentences in subtreePool, a SubtreePool
+    # of SUBTREE_PROCS processes set by the caller. Only plain bottom-up
+    # cube pruning is supported.
+    self.SUBTREE_PROCS = FLAGS.subtreeprocs
+    if FLAGS.cubegrowing or FLAGS.coarsetofine is not None or not self.DO_RESCORE:
+      self.SUBTREE_PROCS = None
+    self.subtreePool = None
+    # Discard cube neighbors whose score bound can't make the beam.
+    # Needs real scores in the queue, so not with lazy cube pruning.
+    self.BOUND_PRUNING = FLAGS.boundpruning and self.DO_RESCORE and not self.LAZY_CUBE
+    # Node parts of the bounds, by id of the tree node; see nonlocalBound
+    self.nodeBounds = { }
+    # Coarse-to-fine: prune with the top COARSE_N items of a local-only pass
+    self.COARSE_N = FLAGS.coarsetofine
+    if not self.DO_RESCORE:
+      self.COARSE_N = None
+    # Cube growing only builds the 1-best forest. Without rescoring, the
+    # exact local decoder is used instead.
+    self.CUBE_GROWING = FLAGS.cubegrowing and DECODING and self.DO_RESCORE
     if DECODING:
       self.COMPUTE_1BEST = True
     else:
@@ -107,16 +286,44 @@ class Model(object):
     if FLAGS.a2 is not None:
       self.a2 = readAlignmentString(a2)
 
+    # User-supplied hard constraints, "forced links ||| forbidden links"
+    self.forced = { }
+    self.forbidden = { }
+    if constraints is not None:
+      fields = constraints.split('|||')
+      self.forced = readAlignmentString(fields[0])
+      if len(fields) > 1:
+        self.forbidden = readAlignmentString(fields[1])
+
     self.modelBest = None
+    self.nbest = None
     self.oracle = None
+    # Gold oracle (links, scoreVector, fscore) of an earlier epoch. If set,
+    # we don't search for the oracle again.
+    self.cachedOracle = None
+    # Is the gold oracle independent of the weights, and thus safe to cache?
+    # See terminal_operation.
+    self.oracleFixed = True
+    self.hope = None
+    self.fear = None
     self.gold = None
 
     self.id = id
     self.pef = { }
     self.pfe = { }
+    self.candidateIndex = None
 
     self.etree = stringToTree_weakRef(etree)
+    if FLAGS.binarize is not None and FLAGS.binarize != "none":
+      if FLAGS.binarize not in ("left", "right", "head"):
+        sys.stderr.write("Unknown value: binarize=%s\n" %(FLAGS.binarize))
+        sys.exit(1)
+      if self.etree.data is not None:
+        binarize(self.etree, FLAGS.binarize)
     self.etree.terminals = self.etree.getPreTerminals()
+    self.schedule = None
+    if self.etree.data is not None:
+      self.setupSchedule(etree)
     if ftree is not None:
       self.ftree = stringToTree_weakRef(ftree)
       self.ftree.terminals = self.ftree.getPreTerminals()
@@ -154,6 +361,33 @@ class Model(object):
     self.info['e'] = self.e
     self.info['etree'] = self.etree
     self.info['ftree'] = self.ftree
+    self.info['fPunc'] = [self.nonlocalFeatures.isPunctuation(fWord) for fWord in self.f]
+
+  def setupSchedule(self, etreeString):
+    """
+    Get the bottom-up visit schedule for self.etree, compiling it only if we
+    haven't seen this tree before, and store precomputed spans and heights
+    on the tree nodes.
+    """
+    compiled = scheduleCache.get(etreeString, None)
+    if compiled is None:
+      compiled = compileSchedule(self.etree)
+      if self.FLAGS.train:
+        scheduleCache[etreeString] = compiled
+    schedule, spans, heights = compiled
+
+    nodes = postorder(self.etree)
+    for i, node in enumerate(nodes):
+      node.span = spans[i]
+      node.height = heights[i]
+    self.schedule = [ ]
+    for i, cellChildren in schedule:
+      node = nodes[i]
+      if cellChildren is not None:
+        node.cellChildren = [nodes[c] for c in cellChildren]
+      self.schedule.append(node)
+    # The root cell; the tree root shares it through a chain of unary nodes
+    self.rootCell = self.schedule[-1]
 
   ########################################
   # Initialize feature function list
@@ -195,40 +429,176 @@ class Model(object):
     self.featureTemplates_nonlocal.append(nonlocalFeatures.ff_nonlocal_tgtTag_srcTag)
     self.featureTemplates_nonlocal.append(nonlocalFeatures.ff_nonlocal_crossb)
 
+    # Upper bounds on the weighted contribution of each template, per node
+    # or per edge, if declared; see nonlocalBound and edgeBound
+    self.nonlocalFeatures = nonlocalFeatures
+    self.featureBounds_nonlocal = [getattr(nonlocalFeatures, func.__name__.replace('ff_', 'ub_', 1), None)
+                                   for func in self.featureTemplates_nonlocal]
+    self.featureDeltas_nonlocal = [getattr(nonlocalFeatures, func.__name__.replace('ff_', 'delta_', 1), None)
+                                   for func in self.featureTemplates_nonlocal]
+    # Batched versions of the templates, if declared; see scoreEdges
+    self.featureBatches_nonlocal = [getattr(nonlocalFeatures, func.__name__.replace('ff_', 'batch_', 1), None)
+                                    for func in self.featureTemplates_nonlocal]
+    # Incremental versions of the templates, if declared; see scoreEdges
+    self.featureJoins_nonlocal = [getattr(nonlocalFeatures, func.__name__.replace('ff_', 'join_', 1), None)
+                                  for func in self.featureTemplates_nonlocal]
+
   def align(self):
     """
     Main wrapper for performing alignment.
     """
+    self.setupCandidates()
+    if self.cachedOracle is not None:
+      self.COMPUTE_ORACLE = False
     ##############################################
     # Do the alignment, traversing tree bottom up.
+    # If we run out of budget, search again with a smaller beam, and then
+    # with the local-only decoder.
     ##############################################
-    self.bottom_up_visit()
+    while True:
+      self.startBudget()
+      self.oracleFixed = True
+      self.nbest = None
+      try:
+        self.bottom_up_visit()
+        if self.CUBE_GROWING and self.etree.data is not None:
+          # Only the preterminal cells are full at this point; build the rest
+          # of the forest top-down, on demand.
+          self.grow_root()
+        break
+      except BudgetExceeded, reason:
+        self.resetCells()
+        self.fallback()
+        LOG(INFO, "Sentence %s: %s; retrying at fallback level %d (%s)"
+            %(self.id, reason, self.fallbackLevel,
+              ["", "beam size %d" %(self.NT_BEAM), "local features only"][self.fallbackLevel]))
     # *DONE* Now finalize everything; final bookkeeping.
 
     if self.COMPUTE_1BEST:
       self.modelBest = self.etree.partialAlignments[0]
+      # The search only builds a separate n-best list when N exceeds the
+      # root beam; otherwise it is the top of the root cell.
+      if self.NBEST is not None and self.nbest is None:
+        self.nbest = self.etree.partialAlignments[:self.NBEST]
     if self.COMPUTE_ORACLE:
       self.oracle = self.etree.oracle
+      # The local-only fallback drops nonlocal features from the oracle
+      if self.fallbackLevel == 2:
+        self.oracleFixed = False
+    elif self.cachedOracle is not None:
+      links, scoreVector, fscore = self.cachedOracle
+      self.oracle = PartialGridAlignment()
+      self.oracle.links = list(links)
+      self.oracle.scoreVector = scoreVector
+      self.oracle.fscore = fscore
+      self.oracle.score = scoreVector.dot(self.weights)
     if self.COMPUTE_HOPE:
       self.hope = self.etree.partialAlignments_hope[0]
     if self.COMPUTE_FEAR:
       self.fear = self.etree.partialAlignments_fear[0]
+    # Only the items used in weight updates need full feature vectors
+    for item in (self.modelBest, self.oracle, self.hope, self.fear):
+      if item is not None:
+        self.featureVector(item)
 
-  def bottom_up_visit(self):
+  def setupCandidates(self):
+    """
+    Build the candidate index of the sentence pair. pef and pfe are only
+    set after the model is constructed.
     """
-    Visit each node in the tree, bottom up, and in level-order.
+    # Long sentence pairs are split into chunks at anchor points; each e
+    # word then only links into the f window of its chunk.
+    windows = None
+    # Forced links are anchors, too.
+    if self.FLAGS.chunkminlength is not None and max(self.lenE, self.lenF) >= self.FLAGS.chunkminlength:
+      anchors = dict(self.a1)
+      anchors.update(self.forced)
+      windows = chunkWindows(self.f, self.e, anchors,
+                             self.LOCAL_FEATURES.isPunctuation,
+                             slack = self.FLAGS.chunkslack)
+    self.candidateIndex = CandidateIndex(self.f, self.e, self.pef, self.pfe,
+                                         self.a1, self.a2, self.inverse,
+                                         fanout = self.FLAGS.candidates,
+                                         band = self.FLAGS.band,
+                                         maxLinkGap = self.MAX_LINK_GAP,
+                                         windows = windows,
+                                         forced = self.forced,
+                                         forbidden = self.forbidden)
 
-    ###########################################################
-    # bottom_up_visit(self):
-    # traverse etree bottom-up, in level order
-    # (1) Add terminal nodes to the visit queue
-    # (2) As each node is visited, add its parent to the visit
-    #     queue if not already on the queue
-    # (3) During each visit, perform the proper alignment function
-    #     depending on the type of node: 'terminal' or 'non-terminal'
-    ###########################################################
+  ################################################################################
+  # Search budget
+  ################################################################################
+  def startBudget(self):
+    """
+    Start the budget for one search. The local-only decoder, our last
+    resort, runs without a budget. The first search keeps the beam sizes
+    for it.
+    """
+    self.numEdges = 0
+    self.deadline = None
+    if self.fallbackLevel == 0:
+      self.fullBeamSizes = (self.BEAM_SIZE, self.NT_BEAM)
+    if self.fallbackLevel == 2:
+      return
+    if self.TIME_BUDGET is not None:
+      self.deadline = time.time() + self.TIME_BUDGET
+
+  def checkBudget(self):
+    """
+    Raise BudgetExceeded if the current search is out of time or edges.
+    """
+    if self.fallbackLevel == 2:
+      return
+    if self.deadline is not None and time.time() > self.deadline:
+      raise BudgetExceeded("time budget of %gs exceeded" %(self.TIME_BUDGET))
+    if self.EDGE_BUDGET is not None and self.numEdges > self.EDGE_BUDGET:
+      raise BudgetExceeded("edge budget of %d exceeded" %(self.EDGE_BUDGET))
+
+  def fallback(self):
+    """
+    Move to the next fallback level.
+    Level 1: a quarter of the beam size.
+    Level 2: the local-only decoder (see --rescore), with the full beam
+    size again. A cached gold oracle has nonlocal feature values the other
+    hypotheses then lack, so the search computes the oracle again.
+    """
+    self.fallbackLevel += 1
+    if self.fallbackLevel == 1 and self.NT_BEAM == 1 and self.BEAM_SIZE == 1:
+      # The beam can't get any smaller
+      self.fallbackLevel = 2
+    if self.fallbackLevel == 1:
+      self.BEAM_SIZE = max(1, self.BEAM_SIZE/4)
+      self.NT_BEAM = max(1, self.NT_BEAM/4)
+    else:
+      self.BEAM_SIZE, self.NT_BEAM = self.fullBeamSizes
+      self.DO_RESCORE = False
+      self.CUBE_GROWING = False
+      self.COARSE_N = None
+      self.BOUND_PRUNING = False
+      self.SUBTREE_PROCS = None
+      if self.cachedOracle is not None:
+        self.cachedOracle = None
+        self.COMPUTE_ORACLE = True
+
+  def resetCells(self):
+    """
+    Throw away the cells of a search that ran out of budget.
+    """
+    for node in self.schedule + [self.etree]:
+      node.partialAlignments = None
+      node.partialAlignments_hope = None
+      node.partialAlignments_fear = None
+      node.oracle = None
+      node.cubeCells = node.cubeQueue = node.cubeCount = None
+      node.cubeEdges = node.cubeBest = None
+      node.kbest = node.kbestQueue = node.kbestSeen = None
+
+  def bottom_up_visit(self):
+    """
+    Visit each node in the tree, bottom up, following the precompiled
+    schedule. During each visit, perform the proper alignment function
+    depending on the type of node: 'terminal' or 'non-terminal'.
     """
-    queue = [ ]
     if self.etree.data is None:
       empty = PartialGridAlignment()
       empty.score = None
@@ -239,29 +609,362 @@ class Model(object):
       self.etree.oracle = PartialGridAlignment()
       return
 
-    # Add first-level nodes to the queue
-    for terminal in self.etree.getTerminals():
-      queue.append(terminal)
-
-    # Visit each node in the queue and put parent
-    # in queue if not there already
-    # Parent is there already if it is the last one in the queue
-    while len(queue) > 0:
-      currentNode = queue.pop(0)
-
-      # Put parent in the queue if it is not there already
-      # We are guaranteed to have visited all of a node's children before we visit that node
-      if (currentNode.parent is not None) and (len(queue) == 0 or queue[-1] is not currentNode.parent()):
-        if abs(currentNode.parent().depth() - currentNode.depth()) == 1:
-          queue.append(currentNode.parent())
-
-      # Visit node here.
-      # if currentNode.isTerminal():
-      # Is current node a preterminal?
-      if len(currentNode.children[0].children) == 0:
+    # Cells already filled by the process pool
+    done = set()
+    if self.SUBTREE_PROCS is not None and self.subtreePool is not None and \
+       self.lenE >= self.FLAGS.subtreeminlength:
+      done = self.parallel_visit()
+
+    # Preterminal cells don't depend on anything; fill them first.
+    for i, currentNode in enumerate(self.schedule):
+      if currentNode.cellChildren is None and i not in done:
+        self.checkBudget()
         self.terminal_operation(currentNode.eIndex, currentNode)
+
+    if self.COARSE_N is not None:
+      self.coarse_pass()
+
+    if not self.CUBE_GROWING:
+      for i, currentNode in enumerate(self.schedule):
+        if currentNode.cellChildren is not None and i not in done:
+          self.nonterminal_operation_cube(currentNode)
+    if self.COMPUTE_1BEST and not self.DO_RESCORE:
+      self.local_root()
+
+    # The tree root shares the cell of the root of the schedule.
+    root = self.rootCell
+    self.etree.partialAlignments = root.partialAlignments
+    self.etree.partialAlignments_hope = root.partialAlignments_hope
+    self.etree.partialAlignments_fear = root.partialAlignments_fear
+    self.etree.oracle = root.oracle
+
+  ################################################################################
+  # Intra-sentence parallelism
+  # Sibling subtrees are independent until their parent combines them.
+  # The processes of a SubtreePool align disjoint subtrees and send back
+  # the cells of their roots. The cells above them are filled as usual.
+  ################################################################################
+  def parallel_visit(self):
+    """
+    Split the tree into about twice as many disjoint subtrees as we have
+    processes, by repeatedly splitting the largest one, and align them in a
+    process pool. Return the set of schedule positions filled.
+    Each subtree gets a share of the edge budget in proportion to its
+    number of cells; the rest is left for the cells above the subtrees,
+    and the edges the workers created count against the whole budget.
+    """
+    position = dict([(id(node), i) for i, node in enumerate(self.schedule)])
+    # The cells of a subtree are contiguous in the schedule, ending with its
+    # root; firstCell[i] is where the subtree rooted at cell i begins.
+    self.firstCell = [ ]
+    for i, node in enumerate(self.schedule):
+      if node.cellChildren is None:
+        self.firstCell.append(i)
       else:
-        self.nonterminal_operation_cube(currentNode)
+        self.firstCell.append(self.firstCell[position[id(node.cellChildren[0])]])
+
+    roots = [len(self.schedule)-1]
+    while len(roots) < 2*self.subtreePool.numProcs:
+      splittable = [(i - self.firstCell[i], i) for i in roots
+                    if self.schedule[i].cellChildren is not None]
+      if len(splittable) == 0:
+        break
+      _, largest = max(splittable)
+      roots.remove(largest)
+      roots += [position[id(child)] for child in self.schedule[largest].cellChildren]
+    if len(roots) < 2:
+      return set()
+    roots.sort()
+    if self.EDGE_BUDGET is not None:
+      self.subtreeBudgets = dict([(i, self.EDGE_BUDGET * (i - self.firstCell[i] + 1) / len(self.schedule))
+                                  for i in roots])
+
+    results = self.subtreePool.alignSubtrees(self, roots, self.firstCell,
+                                             self.subtreeBudgets)
+
+    done = set()
+    for i, (cell, cell_hope, cell_fear, oracle, oracleFixed, numEdges) in izip(roots, results):
+      node = self.schedule[i]
+      node.partialAlignments = cell
+      node.partialAlignments_hope = cell_hope
+      node.partialAlignments_fear = cell_fear
+      node.oracle = oracle
+      self.oracleFixed = self.oracleFixed and oracleFixed
+      self.numEdges += numEdges
+      done.update(xrange(self.firstCell[i], i+1))
+    self.checkBudget()
+    return done
+
+  def subtreeSpec(self):
+    """
+    Return what a worker of a SubtreePool needs to build this model again,
+    as it is set up for the current search: (inputs, weights, state).
+    """
+    state = {'BEAM_SIZE': self.BEAM_SIZE,
+             'NT_BEAM': self.NT_BEAM,
+             'COMPUTE_ORACLE': self.COMPUTE_ORACLE,
+             'deadline': self.deadline,
+             'gold': self.gold}
+    return self.inputs, self.weights, state
+
+  ################################################################################
+  # Coarse-to-fine search
+  # A first pass without nonlocal features decides which preterminal
+  # hypotheses are worth searching over with the full model.
+  ################################################################################
+  def coarse_pass(self):
+    """
+    Search with local features only, and collect every preterminal
+    hypothesis (i.e., the set of links to one e word) that appears among the
+    COARSE_N best items of any cell. Then drop all other hypotheses from the
+    preterminal cells. The gold oracle is computed before pruning and is not
+    affected.
+    """
+    # Survivors: eIndex -> set of tuples of linked f indices
+    survivors = defaultdict(set)
+    visited = set()
+    for currentNode in self.schedule:
+      if currentNode.cellChildren is None:
+        for item in currentNode.partialAlignments[:self.COARSE_N]:
+          survivors[currentNode.eIndex].add(self.linkedFIndices(item))
+        continue
+      self.local_kth(currentNode, self.COARSE_N-1)
+      for index in xrange(min(self.COARSE_N, len(currentNode.kbest))):
+        for leaf, item in self.local_leaves(currentNode, index, visited):
+          survivors[leaf.eIndex].add(self.linkedFIndices(item))
+
+    for currentNode in self.schedule:
+      if currentNode.cellChildren is not None:
+        # Local k-best lists are not needed in the full search.
+        currentNode.kbest = None
+        continue
+      allowed = survivors[currentNode.eIndex]
+      for beamName in ('partialAlignments', 'partialAlignments_hope', 'partialAlignments_fear'):
+        cell = getattr(currentNode, beamName)
+        if cell is None:
+          continue
+        pruned = [item for item in cell if self.linkedFIndices(item) in allowed]
+        if len(pruned) == 0:
+          pruned = cell[:1]
+        setattr(currentNode, beamName, pruned)
+
+  def linkedFIndices(self, item):
+    """
+    Key of a preterminal hypothesis: its sorted f indices.
+    """
+    return tuple(sorted([link[0] for link in item.links]))
+
+  ################################################################################
+  # Exact decoding for the local-only model (--rescore false)
+  # An edge then scores the sum of its children, so the k best items of a
+  # cell are exactly the k best combinations of child items. We find them
+  # by lazy k-best merging (Huang and Chiang, 2005, Algorithm 3), keeping
+  # only scores and back-pointers for nonterminals: node.kbest is a list of
+  # (score, position), where position holds one item index per cell child.
+  # Alignments are only built for the items of the root cell.
+  ################################################################################
+  def local_root(self):
+    """
+    Fill the root cell with its k best local-only alignments.
+    """
+    root = self.rootCell
+    if root.cellChildren is not None:
+      beamSize = self.ntBeamSize(root)
+      self.local_kth(root, beamSize-1)
+      root.partialAlignments = [self.local_alignment(root, index)
+                                for index in xrange(len(root.kbest))]
+      # Decoding is exact, so going further down the root list for the
+      # n-best list leaves the items above unchanged.
+      if self.NBEST is not None and self.NBEST > beamSize:
+        self.local_kth(root, self.NBEST-1, self.NBEST)
+        self.nbest = root.partialAlignments + [self.local_alignment(root, index)
+                                               for index in xrange(beamSize, len(root.kbest))]
+
+  def local_score(self, currentNode, index):
+    """
+    Return the score of item number index of the local-only cell of
+    currentNode, or None if the cell has fewer than index+1 items.
+    """
+    if currentNode.cellChildren is None:
+      cell = currentNode.partialAlignments
+      if index < len(cell):
+        return cell[index].score
+      return None
+    return self.local_kth(currentNode, index)
+
+  def local_kth(self, currentNode, index, beamSize = None):
+    """
+    Compute the local-only cell of nonterminal currentNode down to item
+    number index, if we haven't done so yet, and return that item's score.
+    Return None if the cell has fewer than index+1 items.
+    beamSize defaults to ntBeamSize(currentNode).
+    """
+    children = currentNode.cellChildren
+    numChildren = len(children)
+    if currentNode.kbest is None:
+      currentNode.kbest = [ ]
+      currentNode.kbestQueue = [ ]
+      position = (0,)*numChildren
+      scores = [self.local_score(child, 0) for child in children]
+      if None not in scores:
+        heappush(currentNode.kbestQueue, (-sum(scores), position))
+      currentNode.kbestSeen = set([position])
+
+    kbest = currentNode.kbest
+    queue = currentNode.kbestQueue
+    seen = currentNode.kbestSeen
+    if beamSize is None:
+      beamSize = self.ntBeamSize(currentNode)
+    while len(kbest) <= index and len(queue) > 0 and len(kbest) < beamSize:
+      (negScore, position) = heappop(queue)
+      score = -negScore
+      # Scores come out in order, so the margin test is final.
+      if self.BEAM_MARGIN is not None and len(kbest) > 0 and score < kbest[0][0] - self.BEAM_MARGIN:
+        del queue[:]
+        break
+      kbest.append((score, position))
+      for c in xrange(numChildren):
+        neighbor = position[:c] + (position[c]+1,) + position[c+1:]
+        if neighbor in seen:
+          continue
+        childScore = self.local_score(children[c], neighbor[c])
+        if childScore is None:
+          continue
+        seen.add(neighbor)
+        neighborScore = score - self.local_score(children[c], position[c]) + childScore
+        heappush(queue, (-neighborScore, neighbor))
+    if index < len(kbest):
+      return kbest[index][0]
+    return None
+
+  def local_leaves(self, currentNode, index, visited = None):
+    """
+    Yield (preterminal, item) for every preterminal item used by item
+    number index of the local-only cell of currentNode. If visited (a set)
+    is given, skip any (node, index) already expanded in an earlier call.
+    """
+    stack = [(currentNode, index)]
+    while len(stack) > 0:
+      node, i = stack.pop()
+      if visited is not None:
+        if (node, i) in visited:
+          continue
+        visited.add((node, i))
+      if node.cellChildren is None:
+        yield node, node.partialAlignments[i]
+      else:
+        position = node.kbest[i][1]
+        for c, child in enumerate(node.cellChildren):
+          stack.append((child, position[c]))
+
+  def local_alignment(self, currentNode, index):
+    """
+    Build the alignment for item number index of the local-only cell of
+    currentNode from the preterminal items it is made of.
+    """
+    item = PartialGridAlignment()
+    for _, leaf in self.local_leaves(currentNode, index):
+      item.links += leaf.links
+      item.scoreVector += leaf.scoreVector
+    item.score = currentNode.kbest[index][0]
+    if self.COMPUTE_ORACLE or self.COMPUTE_HOPE or self.COMPUTE_FEAR:
+      item.fscore = self.ff_fscore(item, currentNode.span)
+    return item
+
+  ################################################################################
+  # Cube growing (Huang and Chiang, 2007)
+  # Nonterminal cells are not filled bottom-up. Instead, the root asks for
+  # its best items, and every cell computes items only as far down
+  # its list as its parent actually asks for.
+  ################################################################################
+  def grow_root(self):
+    """
+    Fill the root cell to its beam size by cube growing.
+    """
+    root = self.rootCell
+    beamSize = self.ntBeamSize(root)
+    self.grow_cell(root, beamSize-1)
+    cell = list(root.partialAlignments)
+    cell.sort(key=attrgetter('score'), reverse=True)
+    self.etree.partialAlignments = cell
+    # Grow the root further for the n-best list, once the 1-best cell is set
+    if self.NBEST is not None and self.NBEST > beamSize:
+      self.grow_cell(root, self.NBEST-1, self.NBEST)
+      self.nbest = sorted(root.partialAlignments, key=attrgetter('score'), reverse=True)
+
+  def grow_cell(self, currentNode, index, beamSize = None):
+    """
+    Return item number index of the 1-best cell of currentNode, computing
+    it (and all items before it) if we haven't done so yet.
+    Return None if the cell has fewer than index+1 items.
+    beamSize defaults to ntBeamSize(currentNode).
+    Items come in the order they are popped from the cube, which is
+    best-first up to search error from nonlocal features.
+    """
+    cell = currentNode.partialAlignments
+    # Preterminal cells are complete
+    if currentNode.cellChildren is None:
+      if index < len(cell):
+        return cell[index]
+      return None
+
+    numChildren = len(currentNode.cellChildren)
+    span = currentNode.span
+    if cell is None:
+      # First request: set up the cube with the item at position [0,0,...,0]
+      childCells = [ ]
+      for child in currentNode.cellChildren:
+        self.grow_cell(child, 0)
+        childCells.append(child.partialAlignments)
+      currentNode.cubeCells = childCells
+      currentNode.cubeEdges = { }
+      currentNode.cubeQueue = [self.cubeEntry(childCells, [0]*numChildren,
+                                              currentNode, span, 'score',
+                                              currentNode.cubeEdges)]
+      currentNode.cubeCount = defaultdict(int)
+      currentNode.partialAlignments = cell = [ ]
+
+    childCells = currentNode.cubeCells
+    queue = currentNode.cubeQueue
+    count = currentNode.cubeCount
+    edgeCache = currentNode.cubeEdges
+    if beamSize is None:
+      beamSize = self.ntBeamSize(currentNode)
+    while len(cell) <= index and len(queue) > 0 and len(cell) < beamSize:
+      (_, position, currentBestCombinedEdge) = heappop(queue)
+      if currentBestCombinedEdge is None:
+        edges = [childCells[c][position[c]] for c in xrange(numChildren)]
+        currentBestCombinedEdge = self.getCombinedEdge(edges, currentNode,
+                                                       span, edgeCache)
+      # Items more than BEAM_MARGIN below the best so far close the cell
+      if self.BEAM_MARGIN is not None:
+        if currentNode.cubeBest is None or currentBestCombinedEdge.score > currentNode.cubeBest:
+          currentNode.cubeBest = currentBestCombinedEdge.score
+        elif currentBestCombinedEdge.score < currentNode.cubeBest - self.BEAM_MARGIN:
+          del queue[:]
+          break
+      cell.append(currentBestCombinedEdge)
+      if len(cell) >= beamSize:
+        break
+      # Push neighbors, asking the children for the items they need.
+      neighbors = [ ]
+      for componentNumber in xrange(numChildren):
+        neighborPosition = list(position)
+        neighborPosition[componentNumber] += 1
+        if self.grow_cell(currentNode.cellChildren[componentNumber],
+                          neighborPosition[componentNumber]) is None:
+          continue
+        numPredecessors = numChildren - neighborPosition.count(0)
+        count[tuple(neighborPosition)] += 1
+        if count[tuple(neighborPosition)] < numPredecessors:
+          continue
+        neighbors.append(neighborPosition)
+      for entry in self.cubeEntries(childCells, neighbors, currentNode, span,
+                                    'score', edgeCache):
+        heappush(queue, entry)
+    if index < len(cell):
+      return cell[index]
+    return None
 
   ################################################################################
   # nonterminal_operation_cube(self, currentNode):
@@ -273,131 +976,32 @@ class Model(object):
       # Search through that forest for the oracle hypotheses,
       # e.g. hope (or fear)
 
-      # If there is only one child under currentNode,
-      # just copy the contents from child up to currentNode, and move on.
-      numChildren = len(currentNode.children)
-      if numChildren == 1:
-        if self.COMPUTE_1BEST:
-          currentNode.partialAlignments = currentNode.children[0].partialAlignments
-        if self.COMPUTE_ORACLE:
-          currentNode.oracle = currentNode.children[0].oracle
-        if self.COMPUTE_HOPE:
-          currentNode.partialAlignments_hope = currentNode.children[0].partialAlignments_hope
-        if self.COMPUTE_FEAR:
-          currentNode.partialAlignments_fear = currentNode.children[0].partialAlignments_fear
-        return
-
-      # Compute the span of currentNode
-      # span is an ordered pair [i,j] where:
-      # i = index of the first eword in span of currentNode
-      # j = index of the  last eword in span of currentNode
-
-      span = (currentNode.span_start(), currentNode.span_end())
-      currentNode.span = span
-
-      ########################################################################
-      # 1-BEST SEARCH
-      ########################################################################
-      if self.COMPUTE_1BEST:
-          # Initialize
-          queue = []
-          heapify(queue)
-          # Before we push, check to see if object's position is in duplicates
-          # i.e., we have already visited that position and added the resultant object to the queue
-          count = defaultdict(int)
-          # Number of components in position vector is the number of children in the current node
-          # Position vector uniquely identifies a position in the cube
-          # and identifies a unique alignment structure
-          position = [0]*len(currentNode.children)
-
-          # Create structure of first object in position [0,0,0,...,0]
-          # This path identifies the structure that is the best structure
-          # we know of before combination costs (rescoring).
-          edges = [ ]
-          for c in xrange(numChildren):
-            # Object number for current child
-            edgeNumber = position[c]
-            currentChild = currentNode.children[c]
-            edge = currentChild.partialAlignments[edgeNumber]
-            edges.append(edge)
-          newEdge, boundingBox = self.createEdge(edges, currentNode, span)
-
-          # Where did this new edge come from?
-          newEdge.position = list(position)
-          # Add new edge to the queue/buffer
-          heappush(queue, (newEdge.score*-1, newEdge))
-
-          if currentNode.partialAlignments is None:
-              currentNode.partialAlignments = []
-
-          # Keep filling up my cell until self.BEAM_SIZE has been reached *or*
-          # we have exhausted all possible items in the queue
-          while(len(queue) > 0 and len(currentNode.partialAlignments) < self.NT_BEAM):
-            # Find current best
-            (_, currentBestCombinedEdge) = heappop(queue)
-            # Add to my cell
-            self.addPartialAlignment(currentNode.partialAlignments,
-                                     currentBestCombinedEdge,
-                                     self.NT_BEAM)
-            # Don't create and score more edges when we are already full.
-            if len(currentNode.partialAlignments) >= self.NT_BEAM:
-              break
-            # - Find neighbors
-            # - Rescore neighbors
-            # - Add neighbors to the queue to be explored
-            #   o For every child, there exists a neighbor
-            #   o numNeighbors = numChildren
-            for componentNumber in xrange(numChildren):
-              # Compute neighbor position
-              neighborPosition = list(currentBestCombinedEdge.position)
-              neighborPosition[componentNumber] += 1
-              # Is this neighbor out of range?
-              if neighborPosition[componentNumber] >= len(currentNode.children[componentNumber].partialAlignments):
-                continue
-
-              # Has this neighbor already been visited?
-              #if duplicates.has_key(tuple(neighborPosition)):
-              #    continue
-              # Lazy eval trick due to Matthias Buechse:
-              # Only evaluate after both a node's predecessors have been evaluated.
-              # Special case: if any component of neighborPosition is 0, it is on the border.
-              # In this case, it only has one predecessor (the one that led us to this position),
-              # and can be immediately evaluated.
-              if 0 not in neighborPosition and count[tuple(neighborPosition)] < 1:
-                count[tuple(neighborPosition)] += 1
-                continue
-
-              # Now build the neighbor edge
-              neighbor = []
-              for cellNumber in xrange(numChildren):
-                cell = currentNode.children[cellNumber]
-                edgeNumber = neighborPosition[cellNumber]
-                edge = cell.partialAlignments[edgeNumber]
-                neighbor.append(edge)
-              neighborEdge, boundingBox = self.createEdge(neighbor,
-                                                          currentNode,
-                                                          span)
-              neighborEdge.position = neighborPosition
-              heappush(queue, (-1*neighborEdge.score, neighborEdge))
-
-          ####################################################################
-          # Finalize.
-          ####################################################################
-          # Sort model score list.
-          sortedItems = []
-          while(len(currentNode.partialAlignments) > 0):
-            sortedItems.insert(0, heappop(currentNode.partialAlignments))
-          currentNode.partialAlignments = sortedItems
-
-  	   ## --- end 1best computation --- ##
+      # Unary chains have been collapsed in the schedule, so currentNode
+      # has at least two cellChildren. Its span is precomputed.
+      span = currentNode.span
+
+      # Combined edges are shared between the 1-best, hope and fear searches.
+      # Each combination of child edges is created and scored only once.
+      edgeCache = { }
+
+      # Without rescoring, the 1-best cell is filled by the exact local decoder.
+      if self.COMPUTE_1BEST and self.DO_RESCORE:
+        currentNode.partialAlignments = self.cube_prune(currentNode, span,
+                                                        'partialAlignments',
+                                                        'score', edgeCache)
+        # The n-best list comes from a cube of its own, so that the 1-best
+        # cell keeps its beam size. Edges are shared through edgeCache.
+        if (self.NBEST is not None and currentNode is self.rootCell
+            and self.NBEST > self.ntBeamSize(currentNode)):
+          self.nbest = self.cube_prune(currentNode, span, 'partialAlignments',
+                                       'score', edgeCache, self.NBEST)
 
       if self.COMPUTE_ORACLE:
         # Oracle BEFORE beam is applied.
         # Should just copy oracle up from terminal nodes.
-        oracleChildEdges = [c.oracle for c in currentNode.children]
-        oracleAlignment, boundingBox = self.createEdge(oracleChildEdges,
-                                                       currentNode,
-                                                       span)
+        oracleChildEdges = [c.oracle for c in currentNode.cellChildren]
+        oracleAlignment = self.getCombinedEdge(oracleChildEdges, currentNode,
+                                               span, edgeCache)
 
         # Oracle AFTER beam is applied.
         #oracleCandidates = list(currentNode.partialAlignments)
@@ -405,256 +1009,582 @@ class Model(object):
         #oracleAlignment = oracleCandidates[0]
         currentNode.oracle = oracleAlignment
 
-      ########################################################################
-      # HOPE SEARCH
-      ########################################################################
       if self.COMPUTE_HOPE:
-        # Initialize
-        queue_hope = []
-        heapify(queue_hope)
-        # Before we push, check to see if object's position is in duplicates
-        # i.e., we have already visited that position and added the resultant
-        # object to the queue
-        count_hope = defaultdict(int)
-        position = [0]*len(currentNode.children)
-
-        # Create structure of first object in position [0,0,0,...,0]
-        # This path implies a resultant structure that is the best structure
-        # we know of before combination costs (rescoring).
-        edges = [ ]
-        for c in xrange(numChildren):
-          # Object number for current child
-          edgeNumber = position[c]
-          currentChild = currentNode.children[c]
-          edge = currentChild.partialAlignments_hope[edgeNumber]
-          edges.append(edge)
-        newEdge, boundingBox = self.createEdge(edges, currentNode, span)
-        newEdge.hope = newEdge.score + newEdge.fscore
-
-        # Where did this new edge come from?
-        newEdge.position = list(position)
-        # Add new edge to the queue/buffer
-        heappush(queue_hope, (newEdge.hope*-1, newEdge))
-
-        if currentNode.partialAlignments_hope is None:
-          currentNode.partialAlignments_hope = []
-
-        while(len(queue_hope) > 0 and len(currentNode.partialAlignments_hope) < self.NT_BEAM):
-          # Find current best; add to my cell
-          (_, currentBestCombinedEdge_hope) = heappop(queue_hope)
-          self.addPartialAlignment_hope(currentNode.partialAlignments_hope,
-                                        currentBestCombinedEdge_hope,
-                                        self.NT_BEAM)
-          # Don't create and score more edges when we are already full.
-          if len(currentNode.partialAlignments_hope) >= self.NT_BEAM:
-              break
-          # - Find neighbors
-          # - Rescore neighbors
-          # - Add neighbors to the queue to be explored
-          #   o For every child, there exists a neighbor
-          #   o numNeighbors = numChildren
-          for componentNumber in xrange(numChildren):
-            # Compute neighbor position
-            neighborPosition = list(currentBestCombinedEdge_hope.position)
-            neighborPosition[componentNumber] += 1
-            # Is this neighbor out of range?
-            if neighborPosition[componentNumber] >= len(currentNode.children[componentNumber].partialAlignments_hope):
-              continue
+        currentNode.partialAlignments_hope = self.cube_prune(currentNode, span,
+                                                             'partialAlignments_hope',
+                                                             'hope', edgeCache)
+
+      if self.COMPUTE_FEAR:
+        currentNode.partialAlignments_fear = self.cube_prune(currentNode, span,
+                                                             'partialAlignments_fear',
+                                                             'fear', edgeCache)
+
+      if self.RELEASE_BEAMS and self.DO_RESCORE:
+        self.releaseChildren(currentNode)
 
-            # Has this neighbor already been visited?
-            #if duplicates_hope.has_key(tuple(neighborPosition)):
-            #    continue
-            # Lazy eval trick due to Matthias Buechse:
-            # Only evaluate after both a node's predecessors have been evaluated.
-            # Special case: if any component of neighborPosition is 0, it is on the border.
-            # In this case, it only has one predecessor (the one that led us to this position),
-            # and can be immediately evaluated.
-            if 0 not in neighborPosition and count_hope[tuple(neighborPosition)] < 1:
-              count_hope[tuple(neighborPosition)] += 1
+  ################################################################################
+  # releaseChildren(self, currentNode):
+  # Free the cells below currentNode once its own cell is built.
+  ################################################################################
+  def releaseChildren(self, currentNode):
+    """
+    Cut the cells of the cell children of currentNode down to their best
+    item. Unless currentNode is the root, its own items then drop their
+    back-pointers (see flattenEdge), so that the released items below
+    them can be freed. Items of virtual nodes keep theirs until the real
+    node above them is built, since the nonlocal features there look
+    through virtual nodes (see Features.realChildren).
+    The gold oracle, which may also be an item of the cell, keeps its
+    back-pointers, so that its feature vector adds up the same way
+    whatever the weights; see --cacheoracle.
+    """
+    for child in currentNode.cellChildren:
+      for beamName in ('partialAlignments', 'partialAlignments_hope', 'partialAlignments_fear'):
+        cell = getattr(child, beamName)
+        if cell is not None and len(cell) > 1:
+          setattr(child, beamName, cell[:1])
+    if currentNode is not self.rootCell and not currentNode.virtual:
+      for beamName in ('partialAlignments', 'partialAlignments_hope', 'partialAlignments_fear'):
+        cell = getattr(currentNode, beamName)
+        if cell is not None:
+          for edge in cell:
+            if edge is not currentNode.oracle:
+              self.flattenEdge(edge)
+
+  def flattenEdge(self, edge):
+    """
+    Turn the combined edge into one that stands on its own, like a
+    preterminal item: keep its links, its gold link count and the sum of
+    the local feature vectors below it, and drop its children. Its
+    nonlocal values, link index and join states are already on the edge.
+    Only root items are asked for their full feature vector, so a
+    flattened edge only needs the local part in scoreVector.
+    """
+    if edge.children is None:
+      return
+    edge.links
+    if self.gold is not None:
+      self.numCorrectLinks(edge)
+    scoreVector = svector.Vector()
+    stack = list(edge.children)
+    while len(stack) > 0:
+      e = stack.pop()
+      if e.children is None:
+        scoreVector += e.scoreVector
+      else:
+        stack.extend(e.children)
+    edge.scoreVector = scoreVector
+    edge.children = None
+
+  ################################################################################
+  # cube_prune(self, currentNode, span, beamName, objective, edgeCache):
+  # Fill the cell of currentNode named beamName with the ntBeamSize best
+  # combinations of the child cells of the same name, as ranked by objective.
+  ################################################################################
+  def cube_prune(self, currentNode, span, beamName, objective, edgeCache,
+                 beamSize = None):
+    """
+    Cube pruning over the child cells beamName of currentNode.
+    objective is the edge attribute we rank by: 'score', 'hope' or 'fear'.
+    Combined edges are looked up in (and added to) edgeCache, so searches
+    under different objectives never build the same edge twice.
+    beamSize defaults to ntBeamSize(currentNode).
+    Return the new cell, sorted best-first.
+    """
+    childCells = [getattr(child, beamName) for child in currentNode.cellChildren]
+    numChildren = len(childCells)
+
+    # Initialize
+    queue = []
+    heapify(queue)
+    # With bound pruning, bound is the part of the edge bounds that only
+    # depends on the node (see edgeBound), and top is a min-heap of the
+    # beamSize best priorities pushed so far.
+    bound = None
+    if self.BOUND_PRUNING:
+      bound = self.nonlocalBound(currentNode)
+    top = [ ]
+    if beamSize is None:
+      beamSize = self.ntBeamSize(currentNode)
+    # Before we push, check to see if object's position is in duplicates
+    # i.e., we have already visited that position and added the resultant object to the queue
+    count = defaultdict(int)
+    # Number of components in position vector is the number of children in the current node
+    # Position vector uniquely identifies a position in the cube
+    # and identifies a unique alignment structure
+    # Positions live in the queue, not on the edge, since a cached edge may sit
+    # at a different position in the cube of another objective.
+    position = [0]*numChildren
+
+    # Create structure of first object in position [0,0,0,...,0]
+    # This path identifies the structure that is the best structure
+    # we know of before combination costs (rescoring).
+    # Queue entries are (-priority, position, edge). Under lazy cube pruning
+    # edge is None until the entry is popped; priority is then only an estimate.
+    entry = self.cubeEntry(childCells, position, currentNode, span,
+                           objective, edgeCache)
+    heappush(queue, entry)
+    if bound is not None:
+      keepBest(top, -entry[0], beamSize)
+
+    best = None
+    beam = Beam(beamSize, objective)
+    # Keep filling up my cell until beamSize has been reached *or*
+    # we have exhausted all possible items in the queue
+    while(len(queue) > 0 and len(beam) < beamSize):
+      # Find current best
+      (_, position, currentBestCombinedEdge) = heappop(queue)
+      if currentBestCombinedEdge is None:
+        # Lazy: only now build and rescore the edge.
+        edges = [childCells[c][position[c]] for c in xrange(numChildren)]
+        currentBestCombinedEdge = self.getCombinedEdge(edges, currentNode,
+                                                       span, edgeCache)
+      # Stop once items fall more than BEAM_MARGIN below the best so far
+      if self.BEAM_MARGIN is not None:
+        value = getattr(currentBestCombinedEdge, objective)
+        if best is None or value > best:
+          best = value
+        elif value < best - self.BEAM_MARGIN:
+          break
+      # Add to my cell
+      beam.add(currentBestCombinedEdge)
+      # Don't create and score more edges when we are already full.
+      if len(beam) >= beamSize:
+        break
+      # - Find neighbors
+      # - Rescore neighbors, all together
+      # - Add neighbors to the queue to be explored
+      #   o For every child, there exists a neighbor
+      #   o numNeighbors = numChildren
+      neighbors = [ ]
+      for componentNumber in xrange(numChildren):
+        # Compute neighbor position
+        neighborPosition = list(position)
+        neighborPosition[componentNumber] += 1
+        # Is this neighbor out of range?
+        if neighborPosition[componentNumber] >= len(childCells[componentNumber]):
+          continue
+
+        # Lazy eval trick due to Matthias Buechse:
+        # Only evaluate after all of a node's predecessors have been evaluated.
+        # A position has one predecessor for each of its nonzero components.
+        # Special case: on the border of a binary cube there is only one
+        # predecessor (the one that led us to this position), and the
+        # neighbor can be immediately evaluated.
+        # Waiting for every predecessor also keeps us from pushing the same
+        # position twice when there are more than two children.
+        numPredecessors = numChildren - neighborPosition.count(0)
+        count[tuple(neighborPosition)] += 1
+        if count[tuple(neighborPosition)] < numPredecessors:
+          continue
+
+        # Bound pruning: beamSize entries have been pushed that score
+        # better than this neighbor possibly can. At most len(beam) of them
+        # have been popped, so the others fill the beam before this
+        # neighbor would be popped. Don't build it.
+        if bound is not None and len(top) >= beamSize:
+          childEdges = [childCells[c][neighborPosition[c]] for c in xrange(numChildren)]
+          if tuple([id(e) for e in childEdges]) not in edgeCache:
+            upperBound = self.edgeBound(childEdges, currentNode, span, objective, bound)
+            if top[0] > upperBound + 1e-6:
               continue
 
-            # Now build the neighbor edge
-            neighbor = []
-            for cellNumber in xrange(numChildren):
-              cell = currentNode.children[cellNumber]
-              edgeNumber = neighborPosition[cellNumber]
-              edge = cell.partialAlignments_hope[edgeNumber]
-              neighbor.append(edge)
-            neighborEdge, boundingBox = self.createEdge(neighbor,
-                                                        currentNode,
-                                                        span)
-
-            neighborEdge.position = neighborPosition
-            neighborEdge.hope = neighborEdge.fscore + neighborEdge.score
-            heappush(queue_hope, (neighborEdge.hope*-1, neighborEdge))
-
-        sortedItems_hope = []
-        while(len(currentNode.partialAlignments_hope) > 0):
-          (_, obj) = heappop(currentNode.partialAlignments_hope)
-          sortedItems_hope.insert(0, obj)
-        currentNode.partialAlignments_hope = sortedItems_hope
-
-      ########################################################################
-      # FEAR SEARCH
-      ########################################################################
+        neighbors.append(neighborPosition)
+
+      # Now build (or, under lazy cube pruning, estimate) the neighbor edges
+      for entry in self.cubeEntries(childCells, neighbors, currentNode, span,
+                                    objective, edgeCache):
+        heappush(queue, entry)
+        if bound is not None:
+          keepBest(top, -entry[0], beamSize)
+
+    ####################################################################
+    # Finalize.
+    ####################################################################
+    return self.finalizeBeam(beam)
+
+  ################################################################################
+  # ntBeamSize(self, currentNode):
+  # Beam size for the cell of nonterminal currentNode.
+  ################################################################################
+  def ntBeamSize(self, currentNode):
+    """
+    With K_PER_WORD set, small spans get small beams:
+    k(span) = min(NT_BEAM, ceil(K_PER_WORD * |span|)). Otherwise NT_BEAM.
+    """
+    if self.K_PER_WORD is None:
+      return self.NT_BEAM
+    spanLength = currentNode.span[1] - currentNode.span[0] + 1
+    return max(1, min(self.NT_BEAM, int(math.ceil(self.K_PER_WORD * spanLength))))
+
+  ################################################################################
+  # nonlocalBound(self, currentNode):
+  # Upper bound on the change the nonlocal templates without a per-edge
+  # bound can make to the score of an edge at currentNode, beyond removing
+  # the child values they overwrite.
+  ################################################################################
+  def nonlocalBound(self, currentNode):
+    """
+    Sum of the node bounds (ub_nonlocal_X) of the templates without an edge
+    bound (delta_nonlocal_X) at currentNode, or None if some template
+    declares neither. Computed once per node.
+    """
+    key = id(currentNode)
+    if key in self.nodeBounds:
+      return self.nodeBounds[key]
+    total = 0.0
+    for ub, delta in izip(self.featureBounds_nonlocal, self.featureDeltas_nonlocal):
+      if delta is None and ub is None:
+        total = None
+        break
+    # Same test as in scoreEdges: no nonlocal features fire here.
+    if total is not None and currentNode.data is not None and currentNode.data is not '_XXX_' and not currentNode.virtual:
+      maxWeights = self.maxNonlocalWeights()
+      for ub, delta in izip(self.featureBounds_nonlocal, self.featureDeltas_nonlocal):
+        if delta is None:
+          total += ub(self.info, currentNode, currentNode.span, self.weights, maxWeights)
+    self.nodeBounds[key] = total
+    return total
+
+  def edgeBound(self, childEdges, currentNode, span, objective, nodeBound):
+    """
+    Upper bound on the objective of the edge combining childEdges at
+    currentNode, without creating or scoring it: the child scores, plus
+    the nonlocalSlack of the children and nodeBound (see nonlocalBound) for
+    the templates without an edge bound, plus the edge bounds of the others.
+    The F-score term of hope and fear is exact.
+    """
+    probe = PartialGridAlignment()
+    probe.setChildren(childEdges)
+    probe.boundingBox = self.combinedBoundingBox(childEdges)
+    total = nodeBound + sum([e.score + e.nonlocalSlack for e in childEdges])
+    if currentNode.data is not None and currentNode.data is not '_XXX_' and not currentNode.virtual:
+      tgtSpan = None
+      if probe.numLinks > 0:
+        tgtSpan = (probe.boundingBox[0][0], probe.boundingBox[1][0])
+      sharedF = self.sharedF(childEdges)
+      for delta in self.featureDeltas_nonlocal:
+        if delta is not None:
+          total += delta(self.info, currentNode, probe, sharedF, tgtSpan, self.weights, self.treeDistValues)
+    if objective == 'hope':
+      total += self.ff_fscore(probe, span)
+    elif objective == 'fear':
+      total += 1 - self.ff_fscore(probe, span)
+    return total
+
+  def maxNonlocalWeights(self):
+    """
+    Return the table of largest nonlocal feature weights that the template
+    bounds use, computing it only once per weight vector.
+    """
+    if boundCache.get('weights', None) is not self.weights:
+      boundCache['weights'] = self.weights
+      boundCache['maxima'] = self.nonlocalFeatures.maxWeights(self.weights)
+    return boundCache['maxima']
+
+  ################################################################################
+  # finalizeBeam(self, beam):
+  # Sort a beam into a cell and apply the relative beam threshold.
+  ################################################################################
+  def finalizeBeam(self, beam):
+    """
+    Return the items of beam best-first, cut BEAM_MARGIN below the best,
+    and add its pruning statistics to self.beamStats.
+    """
+    cell = beam.finalize(self.BEAM_MARGIN)
+    for name, value in beam.stats().iteritems():
+      self.beamStats[name] += value
+    return cell
+
+  def cubeEntry(self, childCells, position, currentNode, span, objective,
+                edgeCache):
+    """
+    Return the queue entry for the cube item at position; see cubeEntries.
+    """
+    return self.cubeEntries(childCells, [position], currentNode, span,
+                            objective, edgeCache)[0]
+
+  def cubeEntries(self, childCells, positions, currentNode, span, objective,
+                  edgeCache):
+    """
+    Return the queue entries for the cube items at positions.
+    The edges are built and scored right away, all together, unless we do
+    lazy cube pruning and they are not cached yet: then an entry carries
+    only an estimate of its objective and no edge.
+    """
+    entries = [None]*len(positions)
+    toBuild = [ ]
+    childEdgesList = [ ]
+    for i, position in enumerate(positions):
+      childEdges = [childCells[c][position[c]] for c in xrange(len(position))]
+      if self.LAZY_CUBE:
+        edge = edgeCache.get(tuple([id(e) for e in childEdges]), None)
+        if edge is None:
+          entries[i] = (self.estimateEdge(childEdges, objective)*-1, position, None)
+          continue
+      toBuild.append(i)
+      childEdgesList.append(childEdges)
+    edges = self.getCombinedEdges(childEdgesList, currentNode, span, edgeCache)
+    for i, edge in izip(toBuild, edges):
+      entries[i] = (getattr(edge, objective)*-1, positions[i], edge)
+    return entries
+
+  def estimateEdge(self, childEdges, objective):
+    """
+    Cheap estimate of the objective of the edge combining childEdges:
+    the sum of the child model scores, ignoring combination costs.
+    The F-score term of hope and fear is taken as the mean child F-score.
+    """
+    score = sum([e.score for e in childEdges])
+    if objective == 'score':
+      return score
+    fscore = sum([e.fscore for e in childEdges]) / len(childEdges)
+    if objective == 'hope':
+      return score + fscore
+    return score + (1 - fscore)
+
+  def getCombinedEdge(self, childEdges, currentNode, span, edgeCache):
+    """
+    Return the edge combining childEdges; see getCombinedEdges.
+    """
+    return self.getCombinedEdges([childEdges], currentNode, span, edgeCache)[0]
+
+  def getCombinedEdges(self, childEdgesList, currentNode, span, edgeCache):
+    """
+    Return the edges combining each list of child edges in childEdgesList.
+    Only edges not already in edgeCache are created; they are scored
+    together (see scoreEdges). The hope and fear objectives are set on
+    every new edge they are needed for.
+    """
+    edges = [ ]
+    newEdges = [ ]
+    for childEdges in childEdgesList:
+      key = tuple([id(e) for e in childEdges])
+      edge = edgeCache.get(key, None)
+      if edge is None:
+        edge = self.createEdge(childEdges)
+        edgeCache[key] = edge
+        newEdges.append(edge)
+      edges.append(edge)
+    if len(newEdges) > 0:
+      self.scoreEdges(newEdges, currentNode, span)
+    for edge in newEdges:
+      if self.COMPUTE_HOPE:
+        edge.hope = edge.score + edge.fscore
       if self.COMPUTE_FEAR:
-        # Initialize
-        queue_fear = []
-        heapify(queue_fear)
-        # Before we push, check to see if object's position is in duplicates
-        # i.e., we have already visited that position and added the resultant
-        # object to the queue
-        count_fear = defaultdict(int)
-        position = [0]*len(currentNode.children)
-
-        # Create structure of first object in position [0,0,0,...,0]
-        # This path implies a resultant structure that is the best structure
-        # we know of before combination costs (rescoring).
-        edges = [ ]
-        for c in xrange(numChildren):
-          # Object number for current child
-          edgeNumber = position[c]
-          currentChild = currentNode.children[c]
-          edge = currentChild.partialAlignments_fear[edgeNumber]
-          edges.append(edge)
-        newEdge, boundingBox = self.createEdge(edges, currentNode, span)
-        newEdge.fear = (1 - newEdge.fscore) + newEdge.score
-
-        # Where did this new edge come from?
-        newEdge.position = list(position)
-        # Add new edge to the queue/buffer
-        heappush(queue_fear, (newEdge.fear*-1, newEdge))
-
-        if currentNode.partialAlignments_fear is None:
-          currentNode.partialAlignments_fear = []
-
-        while(len(queue_fear) > 0 and len(currentNode.partialAlignments_fear) < self.NT_BEAM):
-          # Find current best; add to my cell
-          (_, currentBestCombinedEdge_fear) = heappop(queue_fear)
-          self.addPartialAlignment_fear(currentNode.partialAlignments_fear,
-                                        currentBestCombinedEdge_fear,
-                                        self.NT_BEAM)
-          # Don't create and score more edges when we are already full.
-          if len(currentNode.partialAlignments_fear) >= self.NT_BEAM:
-            break
-          # - Find neighbors
-          # - Rescore neighbors
-          # - Add neighbors to the queue to be explored
-          #   o For every child, there exists a neighbor
-          #   o numNeighbors = numChildren
-          for componentNumber in xrange(numChildren):
-            # Compute neighbor position
-            neighborPosition = list(currentBestCombinedEdge_fear.position)
-            neighborPosition[componentNumber] += 1
-            # Is this neighbor out of range?
-            if neighborPosition[componentNumber] >= len(currentNode.children[componentNumber].partialAlignments_fear):
-              continue
-            # Has this neighbor already been visited?
-            #if duplicates_fear.has_key(tuple(neighborPosition)):
-            #    continue
-            # Lazy eval trick due to Matthias Buechse:
-            # Only evaluate after both a node's predecessors have been evaluated.
-            # Special case: if any component of neighborPosition is 0, it is on the border.
-            # In this case, it only has one predecessor (the one that led us to this position),
-            # and can be immediately evaluated.
-            if 0 not in neighborPosition and count_fear[tuple(neighborPosition)] < 1:
-              count_fear[tuple(neighborPosition)] += 1
-              continue
+        edge.fear = (1 - edge.fscore) + edge.score
+    return edges
 
-            # Now build the neighbor edge
-            neighbor = []
-            for cellNumber in xrange(numChildren):
-              cell = currentNode.children[cellNumber]
-              edgeNumber = neighborPosition[cellNumber]
-              edge = cell.partialAlignments_fear[edgeNumber]
-              neighbor.append(edge)
-            neighborEdge, boundingBox = self.createEdge(neighbor,
-                                                        currentNode,
-                                                        span)
-            neighborEdge.position = neighborPosition
-            neighborEdge.fear = (1 - neighborEdge.fscore) + neighborEdge.score
-            heappush(queue_fear, (neighborEdge.fear*-1, neighborEdge))
-
-        # FINALIZE
-        sortedItems_fear = []
-        while(len(currentNode.partialAlignments_fear) > 0):
-          (_, obj) = heappop(currentNode.partialAlignments_fear)
-          sortedItems_fear.insert(0, obj)
-        currentNode.partialAlignments_fear = sortedItems_fear
-
-  def createEdge(self, childEdges, currentNode, span):
-    """
-    Create a new edge from the list of edges 'edge'.
-    Creating an edge involves:
-    (1) Initializing the PartialGridAlignment data structure
-    (2) Adding links (f,e) to list newEdge.links
-    (3) setting the score of the edge with scoreEdge(newEdge, ...)
-    In addition, set the score of the new edge.
+  def createEdge(self, childEdges):
+    """
+    Create a new, unscored edge from the list of edges childEdges.
+    The new edge points back to childEdges instead of copying their links
+    or summing their feature vectors; see featureVector. Its bounding box
+    is that of the child boxes.
     """
+    self.numEdges += 1
+    self.checkBudget()
     newEdge = PartialGridAlignment()
-    newEdge.scoreVector = svector.Vector()
-
+    newEdge.scoreVector = None
+    newEdge.setChildren(childEdges)
+
+    if self.LINK_BITS:
+      # Children cover disjoint e spans
+      newEdge.linkBits = 0
+      for e in childEdges:
+        newEdge.linkBits |= self.linkBits(e)
+    newEdge.boundingBox = self.combinedBoundingBox(childEdges)
+    return newEdge
+
+  def combinedBoundingBox(self, childEdges):
+    """
+    Return the bounding box of the child boxes, boxing children that don't
+    have one yet.
+    """
     for e in childEdges:
-      newEdge.links += e.links
-      newEdge.scoreVector += e.scoreVector
-
       if e.boundingBox is None:
         e.boundingBox = self.boundingBox(e.links)
-    score, boundingBox = self.scoreEdge(newEdge,
-                                        currentNode,
-                                        span,
-                                        childEdges)
-    return newEdge, boundingBox
+    boxes = [e.boundingBox for e in childEdges]
+    return ((min([box[0][0] for box in boxes]), min([box[0][1] for box in boxes])),
+            (max([box[1][0] for box in boxes]), max([box[1][1] for box in boxes])))
 
   ############################################################################
-  # scoreEdge(self, edge, currentNode, srcSpan, childEdges):
+  # scoreEdges(self, edges, currentNode, srcSpan):
   ############################################################################
-  def scoreEdge(self, edge, currentNode, srcSpan, childEdges):
+  def scoreEdges(self, edges, currentNode, srcSpan):
     """
-    Score an edge.
-    (1) edge: new hyperedge in the alignment forest, tail of this hyperedge are the edges in childEdges
+    Score new edges.
+    (1) edges: new hyperedges in the alignment forest, all at currentNode;
+        the tails of each are its children
     (2) currentNode: the currentNode in the tree
     (3) srcSpan: span (i, j) of currentNode; i = index of first terminal node in span, j = index of last terminal node in span
-    (4) childEdges: the two (or more in case of general trees) nodes we are combining with a new hyperedge
+    A nonlocal template with an incremental version (see Features.py) only
+    looks at what joining the children adds. Otherwise, a template with a
+    batched version is called once for all edges, and other templates once
+    per edge.
     """
+    if self.COMPUTE_ORACLE or self.COMPUTE_HOPE or self.COMPUTE_FEAR:
+      for edge in edges:
+        edge.fscore = self.ff_fscore(edge, srcSpan)
+
+    if not self.DO_RESCORE:
+      # Without rescoring, an edge scores the sum of its parts.
+      for edge in edges:
+        edge.score = sum([e.score for e in edge.children])
+      return
 
-    if self.COMPUTE_ORACLE:
-      edge.fscore = self.ff_fscore(edge, srcSpan)
-
-    boundingBox = None
-    if self.DO_RESCORE:
-      ##################################################################
-      # Compute data needed for certain feature functions
-      ##################################################################
+    ##################################################################
+    # Compute data needed for certain feature functions
+    ##################################################################
+    tgtSpans = [ ]
+    linkedIndicesList = [ ]
+    deltas = [ ]
+    for edge in edges:
       tgtSpan = None
-      if len(edge.links) > 0:
-        boundingBox = self.boundingBox(edge.links)
-        tgtSpan = (boundingBox[0][0], boundingBox[1][0])
-      edge.boundingBox = boundingBox
-
-      # TODO: This is an awful O(l) patch of code
-      linkedIndices = defaultdict(list)
-      for link in edge.links:
-        fIndex = link[0]
-        eIndex = link[1]
-        linkedIndices[fIndex].append(eIndex)
-
-      scoreVector = edge.scoreVector.copy()
-
-      if currentNode.data is not None and currentNode.data is not '_XXX_':
-        for _, func in enumerate(self.featureTemplates_nonlocal):
-          value_dict = func(self.info, currentNode, edge, edge.links, srcSpan, tgtSpan, linkedIndices, childEdges, self.diagValues, self.treeDistValues)
+      if edge.numLinks > 0:
+        tgtSpan = (edge.boundingBox[0][0], edge.boundingBox[1][0])
+      tgtSpans.append(tgtSpan)
+      linkedIndicesList.append(self.linkIndex(edge))
+
+      # Nonlocal feature values of the subtree. A value computed here
+      # overwrites the sum of the children's values, so the score changes by
+      # the weighted difference.
+      scoreVector_nonlocal = svector.Vector()
+      for e in edge.children:
+        scoreVector_nonlocal += e.scoreVector_nonlocal
+      edge.scoreVector_nonlocal = scoreVector_nonlocal
+      deltas.append(0.0)
+      if self.BOUND_PRUNING:
+        edge.nonlocalSlack = sum([e.nonlocalSlack for e in edge.children])
+
+    # Incremental templates keep their state at every node
+    joinValues = { }
+    for func, join in izip(self.featureTemplates_nonlocal, self.featureJoins_nonlocal):
+      if join is None:
+        continue
+      key = func.__name__
+      joinValues[key] = valueDicts = [ ]
+      for edge, tgtSpan in izip(edges, tgtSpans):
+        if edge.nonlocalState is None:
+          edge.nonlocalState = { }
+        childStates = [e.nonlocalState and e.nonlocalState.get(key, None) for e in edge.children]
+        state, value_dict = join(self.info, currentNode, edge, childStates, edge.sharedF, tgtSpan, self.treeDistValues)
+        edge.nonlocalState[key] = state
+        valueDicts.append(value_dict)
+
+    # Nodes introduced by binarization fire no features of their own
+    if currentNode.data is not None and currentNode.data is not '_XXX_' and not currentNode.virtual:
+      for func, batch, boundDelta in izip(self.featureTemplates_nonlocal, self.featureBatches_nonlocal,
+                                          self.featureDeltas_nonlocal):
+        # Only templates without an edge bound leave slack; see edgeBound
+        slack = self.BOUND_PRUNING and boundDelta is None
+        if func.__name__ in joinValues:
+          valueDicts = joinValues[func.__name__]
+        elif batch is not None:
+          valueDicts = batch(self.info, currentNode, edges, srcSpan, tgtSpans, linkedIndicesList, self.diagValues, self.treeDistValues)
+        else:
+          valueDicts = [func(self.info, currentNode, edge, edge.links, srcSpan, tgtSpan, linkedIndices, edge.children, self.diagValues, self.treeDistValues)
+                        for edge, tgtSpan, linkedIndices in izip(edges, tgtSpans, linkedIndicesList)]
+        for i, value_dict in enumerate(valueDicts):
+          edge = edges[i]
+          scoreVector_nonlocal = edge.scoreVector_nonlocal
           for name, value in value_dict.iteritems():
             if value != 0:
-              scoreVector[name] = value
-      edge.scoreVector = scoreVector
+              deltas[i] += (value - scoreVector_nonlocal[name])*self.weights[name]
+              scoreVector_nonlocal[name] = value
+              if slack:
+                weighted = value*self.weights[name]
+                if weighted < 0:
+                  edge.nonlocalSlack -= weighted
+
+    ##################################################
+    # Compute final score for each partial alignment
+    ##################################################
+    for edge, delta in izip(edges, deltas):
+      edge.score = sum([e.score for e in edge.children]) + delta
 
-      ##################################################
-      # Compute final score for this partial alignment
-      ##################################################
-      edge.score = edge.scoreVector.dot(self.weights)
+  def featureVector(self, edge):
+    """
+    Return the full feature vector of edge, and keep it on the edge.
+    Only preterminal items store their (local) feature vectors; a combined
+    edge is the sum of the preterminal items below it plus its nonlocal
+    values. Nonlocal feature names (ff_nonlocal_*) never clash with local
+    ones, so the nonlocal values simply add on.
+    """
+    if edge.scoreVector is not None:
+      return edge.scoreVector
+    scoreVector = edge.scoreVector_nonlocal.copy()
+    stack = list(edge.children)
+    while len(stack) > 0:
+      e = stack.pop()
+      if e.children is None:
+        scoreVector += e.scoreVector
+      else:
+        stack.extend(e.children)
+    edge.scoreVector = scoreVector
+    return scoreVector
 
-    return edge.score, boundingBox
+  def linkBits(self, edge):
+    """
+    Return the links of edge as an integer bitmask over the f x e grid,
+    computing it from the links if edge doesn't have it yet.
+    """
+    if edge.linkBits is None:
+      edge.linkBits = linkBitmask(edge.links, self.lenF)
+    return edge.linkBits
+
+  def linkIndex(self, edge):
+    """
+    Return the per-f link index of edge: a dictionary from every linked f
+    index to its list of e indices, in link order. Combined edges merge
+    the indexes of their children; lists that only one child contributes
+    are shared with it, so callers must not modify them.
+    Keys are inserted in the order they first appear in the links, which
+    gives the same dictionary iteration order as indexing the flat list.
+    Also record in edge.sharedF the f indices that more than one child
+    links to.
+    """
+    if edge.linkedIndices is not None:
+      return edge.linkedIndices
+    linkedIndices = defaultdict(list)
+    fOrder = [ ]
+    sharedF = [ ]
+    if edge.children is None:
+      for (fIndex, eIndex) in edge.links:
+        if fIndex not in linkedIndices:
+          fOrder.append(fIndex)
+        linkedIndices[fIndex].append(eIndex)
+    else:
+      for e in edge.children:
+        childIndices = self.linkIndex(e)
+        for fIndex in e.fOrder:
+          if fIndex in linkedIndices:
+            if fIndex not in sharedF:
+              sharedF.append(fIndex)
+            linkedIndices[fIndex] = linkedIndices[fIndex] + childIndices[fIndex]
+          else:
+            fOrder.append(fIndex)
+            linkedIndices[fIndex] = childIndices[fIndex]
+    edge.linkedIndices = linkedIndices
+    edge.fOrder = fOrder
+    edge.sharedF = sharedF
+    return linkedIndices
+
+  def sharedF(self, childEdges):
+    """
+    Return the f indices that more than one of childEdges links to, in the
+    order linkIndex records them for the edge combining childEdges.
+    """
+    seen = set()
+    sharedF = [ ]
+    for e in childEdges:
+      self.linkIndex(e)
+      for fIndex in e.fOrder:
+        if fIndex not in seen:
+          seen.add(fIndex)
+        elif fIndex not in sharedF:
+          sharedF.append(fIndex)
+    return sharedF
 
   def boundingBox(self, links):
     """
@@ -693,13 +1623,12 @@ class Model(object):
     # Setup
     ##################################################
 
-    partialAlignments = []
-    partialAlignments_hope = []
-    partialAlignments_fear = []
+    # Ties go to the better model score, then to the item added first
+    beam = Beam(self.BEAM_SIZE, 'score', 'score')
+    beam_hope = Beam(self.BEAM_SIZE, 'hope', 'score')
+    beam_fear = Beam(self.BEAM_SIZE, 'fear', 'score')
     oracleAlignment = None
 
-    heapify(partialAlignments)
-
     tgtWordList = self.f
     srcWordList = self.e
     tgtWord = None
@@ -710,43 +1639,51 @@ class Model(object):
 
     span = (srcIndex, srcIndex)
 
+    # e words with forced links only get alignments that contain them.
+    # Everything else is pruned before scoring.
+    constrained = srcIndex in self.candidateIndex.forced
+
     ##################################################
     # null partial alignment ( assign no links )
     ##################################################
-    tgtIndex = -1
-    tgtWord = '*NULL*'
-    scoreVector = svector.Vector()
-    # Compute feature score
+    if not constrained:
+      tgtIndex = -1
+      tgtWord = '*NULL*'
+      scoreVector = svector.Vector()
+      # Compute feature score
 
-    for k, func in enumerate(self.featureTemplates):
-      value_dict = func(self.info, tgtWord, srcWord, tgtIndex, srcIndex, [], self.diagValues, currentNode)
-      for name, value in value_dict.iteritems():
-        if value != 0:
-          scoreVector[name] += value
+      for k, func in enumerate(self.featureTemplates):
+        value_dict = func(self.info, tgtWord, srcWord, tgtIndex, srcIndex, [], self.diagValues, currentNode)
+        for name, value in value_dict.iteritems():
+          if value != 0:
+            scoreVector[name] += value
 
-    nullPartialAlignment = PartialGridAlignment()
-    nullPartialAlignment.score = score = scoreVector.dot(self.weights)
-    nullPartialAlignment.scoreVector = scoreVector
+      nullPartialAlignment = PartialGridAlignment()
+      nullPartialAlignment.score = score = scoreVector.dot(self.weights)
+      nullPartialAlignment.scoreVector = scoreVector
 
-    self.addPartialAlignment(partialAlignments, nullPartialAlignment, self.BEAM_SIZE)
+      beam.add(nullPartialAlignment)
 
-    if self.COMPUTE_ORACLE or self.COMPUTE_FEAR:
-      nullPartialAlignment.fscore = self.ff_fscore(nullPartialAlignment, span)
+      if self.COMPUTE_ORACLE or self.COMPUTE_HOPE or self.COMPUTE_FEAR:
+        nullPartialAlignment.fscore = self.ff_fscore(nullPartialAlignment, span)
 
-      if self.COMPUTE_ORACLE:
-        oracleAlignment = nullPartialAlignment
-      if self.COMPUTE_HOPE:
-        nullPartialAlignment.hope = nullPartialAlignment.fscore + nullPartialAlignment.score
-        self.addPartialAlignment_hope(partialAlignments_hope, nullPartialAlignment, self.BEAM_SIZE)
-      if self.COMPUTE_FEAR:
-        nullPartialAlignment.fear = (1 - nullPartialAlignment.fscore) + nullPartialAlignment.score
-        self.addPartialAlignment_fear(partialAlignments_fear, nullPartialAlignment, self.BEAM_SIZE)
+        if self.COMPUTE_ORACLE:
+          oracleAlignment = nullPartialAlignment
+        if self.COMPUTE_HOPE:
+          nullPartialAlignment.hope = nullPartialAlignment.fscore + nullPartialAlignment.score
+          beam_hope.add(nullPartialAlignment)
+        if self.COMPUTE_FEAR:
+          nullPartialAlignment.fear = (1 - nullPartialAlignment.fscore) + nullPartialAlignment.score
+          beam_fear.add(nullPartialAlignment)
 
     ##################################################
     # Single-link alignment
     ##################################################
     bestTgtWords = []
-    for tgtIndex, tgtWord in enumerate(tgtWordList):
+    for tgtIndex in self.candidateIndex.candidates(srcIndex):
+      tgtWord = tgtWordList[tgtIndex]
+      if constrained and not self.candidateIndex.allowLinks(srcIndex, (tgtIndex,)):
+        continue
       currentLinks = [(tgtIndex, srcIndex)]
       scoreVector = svector.Vector()
 
@@ -765,22 +1702,22 @@ class Model(object):
       singleLinkPartialAlignment.scoreVector = scoreVector
       singleLinkPartialAlignment.links = currentLinks
 
-      self.addPartialAlignment(partialAlignments, singleLinkPartialAlignment, self.BEAM_SIZE)
+      beam.add(singleLinkPartialAlignment)
 
-      if self.COMPUTE_ORACLE or self.COMPUTE_FEAR:
+      if self.COMPUTE_ORACLE or self.COMPUTE_HOPE or self.COMPUTE_FEAR:
         singleLinkPartialAlignment.fscore = self.ff_fscore(singleLinkPartialAlignment, span)
 
         if self.COMPUTE_ORACLE:
-          if singleLinkPartialAlignment.fscore > oracleAlignment.fscore:
+          if oracleAlignment is None or singleLinkPartialAlignment.fscore > oracleAlignment.fscore:
             oracleAlignment = singleLinkPartialAlignment
 
         if self.COMPUTE_HOPE:
           singleLinkPartialAlignment.hope = singleLinkPartialAlignment.fscore + singleLinkPartialAlignment.score
-          self.addPartialAlignment_hope(partialAlignments_hope, singleLinkPartialAlignment, self.BEAM_SIZE)
+          beam_hope.add(singleLinkPartialAlignment)
 
         if self.COMPUTE_FEAR:
           singleLinkPartialAlignment.fear = (1-singleLinkPartialAlignment.fscore)+singleLinkPartialAlignment.score
-          self.addPartialAlignment_fear(partialAlignments_fear, singleLinkPartialAlignment, self.BEAM_SIZE)
+          beam_fear.add(singleLinkPartialAlignment)
 
     ##################################################
     # Two link alignment
@@ -790,18 +1727,28 @@ class Model(object):
     # Sort the fwords by score
     bestTgtWords.sort(reverse=True)
     LIMIT = max(10, len(bestTgtWords)/2)
-
-    for index1, obj1 in enumerate(bestTgtWords[0:LIMIT]):
-      for _, obj2 in enumerate(bestTgtWords[index1+1:LIMIT]):
-        # clear contents of twoLinkPartialAlignment
-        tgtIndex_a = obj1[1]
-        tgtIndex_b = obj2[1]
+    # Pairs are only built from the LIMIT best single links by model score.
+    # If some are left out, the gold oracle depends on the weights.
+    if LIMIT < len(bestTgtWords) and not constrained:
+      self.oracleFixed = False
+    if constrained:
+      # Pairs must contain the forced links, which may pair with any candidate
+      bestTgtWords = [(0.0, fIndex) for fIndex in self.candidateIndex.candidates(srcIndex)]
+      LIMIT = len(bestTgtWords)
+    # Pairs are built in f order, so neither the order of the two links nor
+    # which of two equally good pairs becomes the oracle depends on the
+    # weights.
+    pairTgtIndices = sorted([tgtIndex for _, tgtIndex in bestTgtWords[0:LIMIT]])
+
+    for index1, tgtIndex_a in enumerate(pairTgtIndices):
+      for tgtIndex_b in pairTgtIndices[index1+1:]:
         # Don't consider a pair (tgtIndex_a, tgtIndex_b) if distance between
-        # these indices > 1 (Arabic/English only).
+        # these indices > MAX_LINK_GAP (default 1 for Arabic/English only).
         # Need to debug feature that is supposed to deal with this naturally.
-        if self.LANG == "ar_en":
-          if (abs(tgtIndex_b - tgtIndex_a) > 1):
-            continue
+        if not self.candidateIndex.allowPair(tgtIndex_a, tgtIndex_b, srcIndex):
+          continue
+        if constrained and not self.candidateIndex.allowLinks(srcIndex, (tgtIndex_a, tgtIndex_b)):
+          continue
 
         tgtWord_a = tgtWordList[tgtIndex_a]
         tgtWord_b = tgtWordList[tgtIndex_b]
@@ -823,47 +1770,30 @@ class Model(object):
         twoLinkPartialAlignment.scoreVector = scoreVector
         twoLinkPartialAlignment.links = currentLinks
 
-        self.addPartialAlignment(partialAlignments, twoLinkPartialAlignment, self.BEAM_SIZE)
-        if self.COMPUTE_ORACLE or self.COMPUTE_FEAR:
+        beam.add(twoLinkPartialAlignment)
+        if self.COMPUTE_ORACLE or self.COMPUTE_HOPE or self.COMPUTE_FEAR:
           twoLinkPartialAlignment.fscore = self.ff_fscore(twoLinkPartialAlignment, span)
 
           if self.COMPUTE_ORACLE:
-            if twoLinkPartialAlignment.fscore > oracleAlignment.fscore:
+            if oracleAlignment is None or twoLinkPartialAlignment.fscore > oracleAlignment.fscore:
               oracleAlignment = twoLinkPartialAlignment
 
           if self.COMPUTE_HOPE:
             twoLinkPartialAlignment.hope = twoLinkPartialAlignment.fscore + twoLinkPartialAlignment.score
-            self.addPartialAlignment_hope(partialAlignments_hope, twoLinkPartialAlignment, self.BEAM_SIZE)
+            beam_hope.add(twoLinkPartialAlignment)
 
           if self.COMPUTE_FEAR:
             twoLinkPartialAlignment.fear = (1-twoLinkPartialAlignment.fscore)+twoLinkPartialAlignment.score
-            self.addPartialAlignment_fear(partialAlignments_fear, twoLinkPartialAlignment, self.BEAM_SIZE)
+            beam_fear.add(twoLinkPartialAlignment)
 
     ########################################################################
-    # Finalize. Sort model-score list and then hope list.
+    # Finalize. Sort model-score beam, then fear and hope beams.
     ########################################################################
-    # Sort model score list.
-    sortedBestFirstPartialAlignments = []
-    while len(partialAlignments) > 0:
-      sortedBestFirstPartialAlignments.insert(0,heappop(partialAlignments))
-    # Sort hope score list.
-    if self.COMPUTE_HOPE:
-      sortedBestFirstPartialAlignments_hope = []
-      while len(partialAlignments_hope) > 0:
-        (_, obj) = heappop(partialAlignments_hope)
-        sortedBestFirstPartialAlignments_hope.insert(0,obj)
-    # Sort fear score list.
-    if self.COMPUTE_FEAR:
-      sortedBestFirstPartialAlignments_fear = []
-      while len(partialAlignments_fear) > 0:
-        (_, obj) = heappop(partialAlignments_fear)
-        sortedBestFirstPartialAlignments_fear.insert(0, obj)
-
-    currentNode.partialAlignments = sortedBestFirstPartialAlignments
+    currentNode.partialAlignments = self.finalizeBeam(beam)
     if self.COMPUTE_FEAR:
-      currentNode.partialAlignments_fear = sortedBestFirstPartialAlignments_fear
+      currentNode.partialAlignments_fear = self.finalizeBeam(beam_fear)
     if self.COMPUTE_HOPE:
-      currentNode.partialAlignments_hope = sortedBestFirstPartialAlignments_hope
+      currentNode.partialAlignments_hope = self.finalizeBeam(beam_hope)
     if self.COMPUTE_ORACLE:
       currentNode.oracle = None
       # Oracle BEFORE beam is applied
@@ -874,63 +1804,6 @@ class Model(object):
       #oracleCandidates.sort(key=attrgetter('fscore'),reverse=True)
       #currentNode.oracle = oracleCandidates[0]
   ############################################################################
-  # addPartialAlignment(self, list, partialAlignment):
-  # Add partial alignment to the list of possible partial alignments
-  # - Make sure we only keep P partial alignments at any one time
-  # - If new partial alignment is > than min(list)
-  # - - Replace min(list) with new partialAlignment
-  ############################################################################
-
-  def addPartialAlignment(self, list, partialAlignment, BEAM_SIZE):
-      # Sort this heap with size limit self.BEAM_SIZE in worst-first order
-      # A low score is worse than a higher score
-
-      if len(list) < BEAM_SIZE:
-        heappush(list, partialAlignment)
-      elif partialAlignment > list[0]:
-        heappushpop(list, partialAlignment)
-
-  ############################################################################
-  # addPartialAlignment(self, list, partialAlignment):
-  # Add partial alignment to the list of possible partial alignments
-  # - Make sure we only keep P partial alignments at any one time
-  # - If new partial alignment is > than min(list)
-  # - - Replace min(list) with new partialAlignment
-  ############################################################################
-
-  def addPartialAlignment_hope(self, list, partialAlignment, BEAM_SIZE):
-      # Sort this heap with size limit self.BEAM_SIZE in worst-first order
-      # A low score is worse than a higher score
-      # Use the tuple trick to force Python's
-      # heapq to sort by the hope score
-
-      if len(list) < BEAM_SIZE:
-        heappush(list,  (partialAlignment.hope, partialAlignment))
-      else:
-        if partialAlignment.hope > list[0][0]:
-          heappushpop(list, (partialAlignment.hope, partialAlignment))
-
-  ############################################################################
-  # addPartialAlignment(self, list, partialAlignment):
-  # Add partial alignment to the list of possible partial alignments
-  # - Make sure we only keep P partial alignments at any one time
-  # - If new partial alignment is > than min(list)
-  # - - Replace min(list) with new partialAlignment
-  ############################################################################
-
-  def addPartialAlignment_fear(self, list, partialAlignment, BEAM_SIZE):
-      # Sort this heap with size limit self.BEAM_SIZE in worst-first order
-      # A low score is worse than a higher score
-      # Use the tuple trick to force Python's heapq to sort by the
-      # fear score
-
-      if len(list) < BEAM_SIZE:
-        heappush(list,  (partialAlignment.fear, partialAlignment))
-      else:
-        if partialAlignment.fear > list[0][0]:
-          heappushpop(list, (partialAlignment.fear, partialAlignment))
-
-  ############################################################################
   # ff_fscore(self):
   # Compute f-score of an edge wrt the entire gold alignment
   # It shouldn't matter if we compute f-score of an edge wrt the entire
@@ -938,22 +1811,37 @@ class Model(object):
   # former will just have a lower recall figure.
   ############################################################################
 
+  def numCorrectLinks(self, edge):
+    """
+    Return the number of links of edge that are in the gold alignment.
+    Combined edges add up the counts of their children, so only preterminal
+    items look at links. The count is cached on the edge.
+    """
+    if edge.numCorrect is None:
+      if edge.children is not None:
+        edge.numCorrect = sum([self.numCorrectLinks(child) for child in edge.children])
+      elif self.LINK_BITS:
+        bits = edge.linkBits
+        if bits is None:
+          bits = self.linkBits(edge)
+        edge.numCorrect = popcount(bits & self.gold.getBitmask(self.lenF))
+      else:
+        inGold = self.gold.links_dict.has_key
+        numCorrect = 0
+        for link in edge.links:
+          numCorrect += inGold(link)
+        edge.numCorrect = numCorrect
+    return edge.numCorrect
+
   def ff_fscore(self, edge, span = None):
     if span is None:
       span = (0, len(self.e)-1)
 
-    # get gold matrix span that we are interested in
-    # Will be faster than using the matrix operation since getLinksByEIndex
-    # returns a sparse list. We also memoize.
-    numGoldLinks = self.gold.numLinksInSpan.get(span, None)
-    if numGoldLinks is None:
-      numGoldLinks = len(self.gold.getLinksByEIndex(span))
-      self.gold.numLinksInSpan[span] = numGoldLinks
-    else:
-      numGoldLinks = self.gold.numLinksInSpan[span]
+    # Gold links in the span come from a prefix-sum table over e indices
+    numGoldLinks = self.gold.numLinksInSpan(span)
 
     # Count our links within this span.
-    numModelLinks = len(edge.links)
+    numModelLinks = edge.numLinks
 
     # (1) special case: both empty
     if numGoldLinks == 0 and numModelLinks == 0:
@@ -966,11 +1854,7 @@ class Model(object):
     # The remainder here is executed when numGoldLinks > 0 and
     # numModelLinks > 0
 
-    inGold = self.gold.links_dict.has_key
-    numCorrect = 0
-    for link in edge.links:
-      numCorrect += inGold(link)
-    numCorrect = float(numCorrect)
+    numCorrect = float(self.numCorrectLinks(edge))
 
     precision = numCorrect / numModelLinks
     recall = numCorrect / numGoldLinks
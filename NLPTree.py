@@ -17,9 +17,25 @@ class NLPTree(Tree):
   order = 0
   i = -1
   j = -1
+  # introduced by binarization, not by the parser
+  virtual = False
+  # this subtree without its virtual nodes (see NLPTreeHelper.unbinarized)
+  unbinarizedView = None
   partialAlignments = None
   partialAlignments_hope = None
   partialAlignments_fear = None
+  # nodes whose cells this node's cell is built from
+  cellChildren = None
+  # cube growing state
+  cubeCells = None
+  cubeQueue = None
+  cubeCount = None
+  cubeEdges = None
+  cubeBest = None
+  # local-only k-best state
+  kbest = None
+  kbestQueue = None
+  kbestSeen = None
 
   def __init__(self, data = None, children = None):
     self.data = data
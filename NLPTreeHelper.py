@@ -91,9 +91,178 @@ def addSpans(tree):
 
   return tree
 
+# Head rules for English PTB labels, in the spirit of (Collins, 1999):
+# label -> (search direction, child labels in order of priority)
+HEAD_RULES = {
+  'ADJP':   ('left', ['NNS', 'QP', 'NN', '$', 'ADVP', 'JJ', 'VBN', 'VBG', 'ADJP',
+                      'JJR', 'NP', 'JJS', 'DT', 'FW', 'RBR', 'RBS', 'SBAR', 'RB']),
+  'ADVP':   ('right', ['RB', 'RBR', 'RBS', 'FW', 'ADVP', 'TO', 'CD', 'JJR', 'JJ',
+                       'IN', 'NP', 'JJS', 'NN']),
+  'NP':     ('right', ['NN', 'NNP', 'NNPS', 'NNS', 'NX', 'POS', 'JJR', 'CD', 'JJ',
+                       'NP', 'PRP']),
+  'PP':     ('left', ['IN', 'TO', 'VBG', 'VBN', 'RP', 'FW']),
+  'S':      ('left', ['TO', 'IN', 'VP', 'S', 'SBAR', 'ADJP', 'UCP', 'NP']),
+  'SBAR':   ('left', ['WHNP', 'WHPP', 'WHADVP', 'WHADJP', 'IN', 'DT', 'S', 'SQ',
+                      'SINV', 'SBAR', 'FRAG']),
+  'SINV':   ('left', ['VBZ', 'VBD', 'VBP', 'VB', 'MD', 'VP', 'S', 'SINV', 'ADJP',
+                      'NP']),
+  'SQ':     ('left', ['VBZ', 'VBD', 'VBP', 'VB', 'MD', 'VP', 'SQ']),
+  'VP':     ('left', ['TO', 'VBD', 'VBN', 'MD', 'VBZ', 'VB', 'VBG', 'VBP', 'VP',
+                      'ADJP', 'NN', 'NNS', 'NP']),
+  'WHNP':   ('left', ['WDT', 'WP', 'WP$', 'WHADJP', 'WHPP', 'WHNP']),
+  'QP':     ('left', ['$', 'IN', 'NNS', 'NN', 'JJ', 'RB', 'DT', 'CD', 'NCD', 'QP',
+                      'JJR', 'JJS']),
+}
+
+def headChild(node):
+  """
+  Return the index of the head child of node, according to HEAD_RULES.
+  Unknown labels are headed by their leftmost child.
+  """
+  label = node.data
+  if label is not None and not label.startswith('-'):
+    # Strip function tags, e.g. NP-SBJ
+    label = label.split('-')[0]
+  direction, priorities = HEAD_RULES.get(label, ('left', []))
+  order = range(len(node.children))
+  if direction == 'right':
+    order.reverse()
+  labels = [child.data for child in node.children]
+  for tag in priorities:
+    for i in order:
+      if labels[i] == tag:
+        return i
+  return order[0]
+
+def binarize(tree, mode):
+  """
+  Binarize every node of tree with more than two children, in place.
+  mode is one of 'left' (left-branching), 'right' (right-branching), or
+  'head': the head child is combined with its right siblings first, then
+  with its left siblings.
+  New nodes are labeled @X, for parent label X, and marked virtual.
+  """
+  for node in postorder(tree):
+    n = len(node.children)
+    if n <= 2:
+      continue
+    if mode == 'left':
+      head = 0
+    elif mode == 'right':
+      head = n-1
+    else:
+      head = headChild(node)
+    children = node.children
+    label = node.data
+    if not label.startswith('@'):
+      label = '@' + label
+    # Pairs of subtrees to merge, from the bottom up
+    core = children[head]
+    merges = [(None, right) for right in children[head+1:]]
+    merges += [(left, None) for left in reversed(children[:head])]
+    for left, right in merges[:-1]:
+      if left is None:
+        core = NLPTree(label, [core, right])
+      else:
+        core = NLPTree(label, [left, core])
+      core.virtual = True
+    left, right = merges[-1]
+    if left is None:
+      node.children = [core, right]
+    else:
+      node.children = [left, core]
+    for ci, child in enumerate(node.children):
+      child.parent = weakref.ref(node)
+      child.order = ci
+  return addSpans(tree)
+
+def unbinarized(tree):
+  """
+  Return tree as it was before binarize: a copy in which the children of
+  every virtual node take its place. The copy keeps the e spans (i, j) of
+  the original nodes. If there are no virtual nodes below tree, return
+  tree itself. The result is kept on tree, since the tree doesn't change
+  during a search.
+  """
+  if tree.unbinarizedView is not None:
+    return tree.unbinarizedView
+  if not [node for node in postorder(tree) if node.virtual]:
+    tree.unbinarizedView = tree
+    return tree
+  def copy(node):
+    if len(node.children) == 0:
+      result = NLPTree(node.data)
+    else:
+      children = [ ]
+      for child in node.children:
+        if child.virtual:
+          children += copy(child).children
+        else:
+          children.append(copy(child))
+      result = NLPTree(node.data, children)
+    result.i = node.i
+    result.j = node.j
+    return result
+  tree.unbinarizedView = copy(tree)
+  return tree.unbinarizedView
+
 def containsSpan(currentNode, fspan):
   """
   Does span of node currentNode wholly contain span fspan?
   """
   span = currentNode.get_span()
   return span[0] <= fspan[0] and span[1] >= fspan[1]
+
+def postorder(tree):
+  """
+  Return the nodes of tree in post-order (children before parents).
+  Iterative, so deep trees don't hit the recursion limit.
+  """
+  nodes = [ ]
+  stack = [(tree, False)]
+  while len(stack) > 0:
+    node, expanded = stack.pop()
+    if expanded or len(node.children) == 0:
+      nodes.append(node)
+    else:
+      stack.append((node, True))
+      for child in reversed(node.children):
+        stack.append((child, False))
+  return nodes
+
+def compileSchedule(tree):
+  """
+  Compile tree into a flat bottom-up visit schedule.
+  Nodes are referred to by their index in postorder(tree), so the same
+  schedule applies to any tree read from the same string.
+
+  Return (schedule, spans, heights):
+  schedule: one entry (index, cellChildren) per node that owns a search cell,
+            in post-order; cellChildren is None for a preterminal, else the
+            indices of the children's cells. Unary chains are collapsed:
+            a unary node shares the cell of its only child, so it gets no
+            entry, and its parent points directly at the cell below it.
+            The last entry is the root cell.
+  spans: (first, last) e-index covered by each node
+  heights: height of each node above the leaves, as returned by Tree.depth()
+  """
+  nodes = postorder(tree)
+  index = dict([(id(node), i) for i, node in enumerate(nodes)])
+  spans = [None]*len(nodes)
+  heights = [0]*len(nodes)
+  cells = range(len(nodes))
+  schedule = [ ]
+  for i, node in enumerate(nodes):
+    if len(node.children) == 0:
+      spans[i] = (node.eIndex, node.eIndex)
+      continue
+    children = [index[id(child)] for child in node.children]
+    spans[i] = (spans[children[0]][0], spans[children[-1]][1])
+    heights[i] = max([heights[c] for c in children]) + 1
+    if len(node.children[0].children) == 0:
+      schedule.append((i, None))
+    elif len(children) == 1:
+      cells[i] = cells[children[0]]
+    else:
+      schedule.append((i, tuple([cells[c] for c in children])))
+  return schedule, spans, heights
@@ -20,22 +20,84 @@ class PartialGridAlignment(object):
     Initialize member objects
     """
     self.links = [ ]
+    # Per-f link index: f index -> e indices, and the f indices in the order
+    # they first appear in links. Built on demand; see Model.linkIndex.
+    self.linkedIndices = None
+    self.fOrder = None
+    # The f indices linked from more than one child edge
+    self.sharedF = None
+    # States of the incremental nonlocal templates (join_nonlocal_*), by
+    # template name; None for preterminal items
+    self.nonlocalState = None
+    # Links as an integer bitmask, with --linkbits; see Model.linkBits
+    self.linkBits = None
+    # Number of links also in the gold alignment; see Model.numCorrectLinks
+    self.numCorrect = None
     self.score = 0
     self.fscore = 0
     self.hope = 0
     self.fear = 0
-    # local feature vector
+    # local feature vector. Combined edges leave it None until the full
+    # vector is needed (see Model.featureVector).
     self.scoreVector = svector.Vector()
+    # nonlocal feature values of the whole subtree
     self.scoreVector_nonlocal = svector.Vector()
+    # the child edges this edge combines; None for preterminal items and
+    # for items flattened once the cells below them are released
+    self.children = None
     self.position = None
     self.boundingBox = None
+    # bound on the score lost when nonlocal values of templates without an
+    # edge bound are overwritten; see GridAlign.edgeBound
+    self.nonlocalSlack = 0.0
+
+  def _getLinks(self):
+    """
+    The flat list of (f,e) links. Combined edges only build it from their
+    children when it is first asked for.
+    """
+    if self._links is None:
+      links = [ ]
+      stack = list(reversed(self.children))
+      while len(stack) > 0:
+        e = stack.pop()
+        if e._links is not None:
+          links.extend(e._links)
+        else:
+          stack.extend(reversed(e.children))
+      self._links = links
+    return self._links
+
+  def _setLinks(self, links):
+    self._links = links
+    self.numLinks = len(links)
+
+  links = property(_getLinks, _setLinks)
+
+  def setChildren(self, children):
+    """
+    Make this edge the combination of the edges in children; its links are
+    theirs, in order.
+    """
+    self.children = children
+    self._links = None
+    self.numLinks = sum([e.numLinks for e in children])
 
   def clear(self):
     self.links = []
+    self.linkedIndices = None
+    self.fOrder = None
+    self.sharedF = None
+    self.nonlocalState = None
+    self.linkBits = None
+    self.numCorrect = None
     self.score = 0
     self.fscore = 0
     self.hope = 0
     self.fear = 0
     self.scoreVector = svector.Vector()
+    self.scoreVector_nonlocal = svector.Vector()
+    self.children = None
     self.position = None
     self.boundingBox = None
+    self.nonlocalSlack = 0.0
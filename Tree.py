@@ -1,6 +1,8 @@
 import weakref
 
 class Tree(object):
+  # precomputed result of depth(), if known
+  height = None
 
   def __init__(self, data = None, children = None):
     self.data = data
@@ -27,6 +29,8 @@ class Tree(object):
     return len(self.children) == 0
 
   def depth(self,d = 0):
+    if self.height is not None:
+      return self.height + d
     maxDepth = d
     for child in self.children:
       childDepth = child.depth(d+1)
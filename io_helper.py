@@ -64,6 +64,20 @@ def open_files(FLAGS):
             write_master("Could not open a2 file %s for reading\n" %(FLAGS.a2))
             sys.exit(3)
 
+    if FLAGS.constraints is not None:
+        try:
+            file_handles['constraints'] = open(FLAGS.constraints, 'r')
+        except:
+            write_master("Could not open constraints file %s for reading\n" %(FLAGS.constraints))
+            sys.exit(3)
+
+    if FLAGS.constraints_dev is not None:
+        try:
+            file_handles['constraints_dev'] = open(FLAGS.constraints_dev, 'r')
+        except:
+            write_master("Could not open constraints_dev file %s for reading\n" %(FLAGS.constraints_dev))
+            sys.exit(3)
+
     if FLAGS.a2_dev is not None:
         try:
             file_handles['a2_dev'] = open(FLAGS.a2_dev, 'r')
@@ -87,6 +87,49 @@ def robustWrite(filename):
     LOG(FATAL, "Could not open file %s for writing. Attempted 10 times." % (filename))
   return filehandle
 
+def readOracleCache(nProcs):
+  """
+  Read the gold oracles cached by all processes in earlier epochs:
+  instance id -> (links, scoreVector, fscore). Each process appends the
+  oracles it found in an epoch to its own file in tmpdir. Instances move
+  between processes from epoch to epoch, so every process reads them all.
+  """
+  oracles = { }
+  for rank in range(nProcs):
+    filename = '%s/oracles.%s' %(tmpdir, str(rank))
+    if not os.path.isfile(filename):
+      continue
+    cache_file = open(filename, 'rb')
+    while True:
+      try:
+        oracles.update(cPickle.load(cache_file))
+      except EOFError:
+        break
+    cache_file.close()
+  return oracles
+
+def writeOracleCache(oracles):
+  """
+  Append the gold oracles found by this process in this epoch to its cache
+  file; see readOracleCache.
+  """
+  if len(oracles) == 0:
+    return
+  cache_file = open('%s/oracles.%s' %(tmpdir, str(mpi.rank)), 'ab')
+  cPickle.dump(oracles, cache_file, protocol=cPickle.HIGHEST_PROTOCOL)
+  cache_file.close()
+
+def writeBeamStats(allBeamStats):
+  """
+  Report the beam pruning statistics gathered from all processes.
+  """
+  total = defaultdict(int)
+  for beamStats in allBeamStats:
+    for name, value in beamStats.iteritems():
+      total[name] += value
+  sys.stderr.write("Beam items added: %d, rejected: %d, evicted: %d, margin-pruned: %d\n"
+                   %(total['added'], total['rejected'], total['evicted'], total['marginPruned']))
+
 def readVocab(infile):
   """ Read vocabulary from an input file, line by line.
   Used later for other tasks, like data filtering. """
@@ -153,17 +196,19 @@ def decode_parallel(weights, indices, blob, name="", out=sys.stdout):
   ##########################################
   startTime = time.time()
   result_file = robustWrite(tmpdir+'/results.'+str(mpi.rank))
+  beamStats = defaultdict(int)
 
   for i, instanceID in enumerate(indices[:FLAGS.subset]):
 
-    f, e, etree, gold_str, ftree, a1, a2, inverse = get_next_instance(blob['f_instances'],
+    f, e, etree, gold_str, ftree, a1, a2, inverse, constraints = get_next_instance(blob['f_instances'],
                                                                       blob['e_instances'],
                                                                       blob['etree_instances'],
                                                                       blob['gold_instances'],
                                                                       blob['ftree_instances'],
                                                                       blob['a1_instances'],
                                                                       blob['a2_instances'],
-                                                                      blob['inverse_instances'])
+                                                                      blob['inverse_instances'],
+                                                                      blob['constraints_instances'])
     if myRank == i % nProcs:
       if FLAGS.train:
         gold = Alignment.Alignment(gold_str)
@@ -178,26 +223,32 @@ def decode_parallel(weights, indices, blob, name="", out=sys.stdout):
                               inverse, DECODING=True,
                               LOCAL_FEATURES=blob['localFeatures'],
                               NONLOCAL_FEATURES=blob['nonlocalFeatures'],
-                              FLAGS=FLAGS)
+                              FLAGS=FLAGS, constraints=constraints)
       if FLAGS.train:
         model.gold = gold
       # Initialize model with data tables
       model.pef = blob['pef']
       model.pfe = blob['pfe']
+      model.subtreePool = blob['subtreePool']
       # Align the current training instance
       # FOR PROFILING: cProfile.run('model.align(1)','profile.out')
       model.align()
+      for name, value in model.beamStats.iteritems():
+        beamStats[name] += value
       # Dump intermediate chunk to disk. Reassemble later.
       if FLAGS.train:
         cPickle.dump((model.modelBest.links, model.gold.links_dict), result_file, protocol=cPickle.HIGHEST_PROTOCOL)
+      elif FLAGS.align and FLAGS.nbest is not None:
+        cPickle.dump([(item.links, item.score) for item in model.nbest], result_file, protocol=cPickle.HIGHEST_PROTOCOL)
       elif FLAGS.align:
         cPickle.dump(model.modelBest.links, result_file, protocol=cPickle.HIGHEST_PROTOCOL)
 
   result_file.close()
-  done = mpi.gather(True, root=0)
+  allBeamStats = mpi.gather(dict(beamStats), root=0)
 
   # REDUCE HERE
   if myRank == masterRank:
+    writeBeamStats(allBeamStats)
     # Open result files for reading
     resultFiles = { }
     for i in range(nProcs):
@@ -242,6 +293,16 @@ def decode_parallel(weights, indices, blob, name="", out=sys.stdout):
       sys.stderr.write('# Me Total: %d\n' % (numModelLinks))
       sys.stderr.write('# Gold Total: %d\n' % (numGoldLinks))
       sys.stderr.write("[%d] Finished decoding.\n" %(myRank))
+    elif FLAGS.nbest is not None:
+      # One line per alignment: sentence id ||| links ||| model score
+      for i, instanceID in enumerate(indices):
+        node = i % nProcs
+        nbest = cPickle.load(resultFiles[node])
+        for links, score in nbest:
+          # Sentences without a parse get an empty alignment with no score
+          if score is None:
+            score = 0.0
+          out.write("%s ||| %s ||| %f\n" %(instanceID, " ".join(map(lambda link: "%s-%s" %(link[0], link[1]), links)), score))
     else:
       for i, instanceID in enumerate(indices):
         node = i % nProcs
@@ -288,17 +349,26 @@ def perceptron_parallel(epoch, indices, blob, weights = None, valid_feature_name
   else:
     weights_sum = svector.Vector()
 
+  # Gold oracles don't depend on the weights; reuse those of earlier epochs
+  cacheOracles = FLAGS.cacheoracle and FLAGS.oracle == 'gold'
+  oracleCache = { }
+  newOracles = { }
+  if cacheOracles:
+    oracleCache = readOracleCache(nProcs)
+
   numChanged = 0
+  beamStats = defaultdict(int)
   done = False
   for i, instanceID in enumerate(indices[:FLAGS.subset]):
-    f, e, etree, gold_str, ftree, a1, a2, inverse = get_next_instance(blob['f_instances'],
+    f, e, etree, gold_str, ftree, a1, a2, inverse, constraints = get_next_instance(blob['f_instances'],
                                                                       blob['e_instances'],
                                                                       blob['etree_instances'],
                                                                       blob['gold_instances'],
                                                                       blob['ftree_instances'],
                                                                       blob['a1_instances'],
                                                                       blob['a2_instances'],
-                                                                      blob['inverse_instances'])
+                                                                      blob['inverse_instances'],
+                                                                      blob['constraints_instances'])
 
     if myRank == i % nProcs:
 
@@ -313,14 +383,21 @@ def perceptron_parallel(epoch, indices, blob, weights = None, valid_feature_name
       model = GridAlign.Model(f, e, etree, ftree, instanceID, weights, a1, a2,
                               inverse, LOCAL_FEATURES=blob['localFeatures'],
                               NONLOCAL_FEATURES=blob['nonlocalFeatures'],
-                              FLAGS=FLAGS)
+                              FLAGS=FLAGS, constraints=constraints)
       model.gold = gold
+      model.cachedOracle = oracleCache.get(instanceID, None)
 
       # Initialize model with data tables
       model.pef = blob['pef']
       model.pfe = blob['pfe']
+      model.subtreePool = blob['subtreePool']
       # Align the current training instance
       model.align()
+      for name, value in model.beamStats.iteritems():
+        beamStats[name] += value
+      if cacheOracles and model.cachedOracle is None and model.oracleFixed:
+        newOracles[instanceID] = (model.oracle.links, model.oracle.scoreVector,
+                                  model.oracle.fscore)
 
       ######################################################################
       # Weight updating
@@ -351,7 +428,11 @@ def perceptron_parallel(epoch, indices, blob, weights = None, valid_feature_name
         validate_features(hyp.scoreVector, valid_feature_names)
 
       deltas = None
-      if set(hyp.links) != set(oracle.links):
+      if FLAGS.linkbits:
+        changed = model.linkBits(hyp) != model.linkBits(oracle)
+      else:
+        changed = set(hyp.links) != set(oracle.links)
+      if changed:
         numChanged += 1
         ###############################################################
         # WEIGHT UPDATES
@@ -379,6 +460,8 @@ def perceptron_parallel(epoch, indices, blob, weights = None, valid_feature_name
           elif w < 0 and w < (FLAGS.tau * -1):
             weights_sum[index] += FLAGS.tau
 
+  writeOracleCache(newOracles)
+
   # Set uniq pickled output file for this process
   # Holds sum of weights over each iteration for this process
   output_filename = "%s/training.%s" %(tmpdir, str(mpi.rank))
@@ -394,10 +477,10 @@ def perceptron_parallel(epoch, indices, blob, weights = None, valid_feature_name
   output_file_last_weights.close()
 
   #############################################
-  # Gather "done" messages from workers
+  # Gather beam statistics from workers
   #############################################
   # Synchronize
-  done = mpi.gather(True,root=0)
+  allBeamStats = mpi.gather(dict(beamStats),root=0)
 
   #####################################################################################
   # Compute f-measure over all alignments
@@ -446,6 +529,7 @@ def perceptron_parallel(epoch, indices, blob, weights = None, valid_feature_name
     # masterRank is printing elapsed time.
     # May differ at each node.
     sys.stderr.write("Time: %0.2f\n" %(elapsedTime))
+    writeBeamStats(allBeamStats)
     sys.stderr.write("[%d] Finished training.\n" %(mpi.rank))
 
   return masterWeights
@@ -527,7 +611,7 @@ def do_training(indices, training_blob, heldout_blob, weights, weights_out, debi
     valid_feature_names = getFeatureNames(debiasing_weights)
 
   # load training instances into memory
-  active_instances = [key for key in ['f_instances','e_instances','etree_instances','ftree_instances','gold_instances','a1_instances','a2_instances','inverse_instances'] if training_blob[key] is not None]
+  active_instances = [key for key in ['f_instances','e_instances','etree_instances','ftree_instances','gold_instances','a1_instances','a2_instances','inverse_instances','constraints_instances'] if training_blob[key] is not None]
   for key in active_instances:
     training_blob[key+'_unshuffled'] = training_blob[key].readlines()
 
@@ -585,7 +669,7 @@ def do_training(indices, training_blob, heldout_blob, weights, weights_out, debi
 
 
 # read all relevant data for the next sentence
-def get_next_instance(f,e,etrees,gold,ftrees,a1,a2,inverse):
+def get_next_instance(f,e,etrees,gold,ftrees,a1,a2,inverse,constraints):
     f_line = f.readline().strip()
     e_line = e.readline().strip()
     etree = etrees.readline().strip()
@@ -609,8 +693,12 @@ def get_next_instance(f,e,etrees,gold,ftrees,a1,a2,inverse):
         inverse_line = inverse.readline().strip()
     else:
         inverse_line = None
+    if constraints is not None:
+        constraints_line = constraints.readline().strip()
+    else:
+        constraints_line = None
 
-    return f_line, e_line, etree, gold_line, ftree, a1_line, a2_line, inverse_line
+    return f_line, e_line, etree, gold_line, ftree, a1_line, a2_line, inverse_line, constraints_line
 
 if __name__ == "__main__":
     myRank = mpi.rank
@@ -625,8 +713,10 @@ if __name__ == "__main__":
     flags.DEFINE_string('a1',None,'Third-party alignments in f-e format.')
     flags.DEFINE_string('a2',None,'Third-party alignments in f-e format.')
     flags.DEFINE_string('inverse',None,'f-e inverse alignments (from bottom-up search on foreign tree)')
+    flags.DEFINE_string('constraints',None,'Hard link constraints, one line per sentence: "forced links ||| forbidden links", both in f-e format. Default: None')
     flags.DEFINE_integer('init_k',None,'k = initialization beam size')
     flags.DEFINE_integer('k',1,'k = standard beam size')
+    flags.DEFINE_integer('nbest',None,'With --align, write the N best alignments of each sentence as "id ||| links ||| score" lines. Does not change the 1-best. At most k^c alignments for a root with c children. Default: None (1-best links only)')
     flags.DEFINE_integer('maxepochs',100,'maximum number of epochs to run training')
     flags.DEFINE_string('fdev',None,'f heldout file')
     flags.DEFINE_string('edev',None,'e heldout file')
@@ -636,6 +726,7 @@ if __name__ == "__main__":
     flags.DEFINE_string('a1_dev',None,'Third-party alignments in f-e format for heldout data')
     flags.DEFINE_string('a2_dev',None,'Third-party alignments in f-e format for heldout data')
     flags.DEFINE_string('inverse_dev',None,'f-e inverse alignments (from bottom-up search on foreign tree)')
+    flags.DEFINE_string('constraints_dev',None,'Hard link constraints for heldout data, see --constraints. Default: None')
     flags.DEFINE_string('srctags',None,'srctags file')
     flags.DEFINE_string('langpair',None,'tell Nile what language-pair it is working on (mostly for importing specific feature sets); default: None')
     flags.DEFINE_string('pef',None,'p(e|f) file')
@@ -645,6 +736,25 @@ if __name__ == "__main__":
     flags.DEFINE_string('oracle','gold','type of oracle. one of {gold, hope}; default: gold')
     flags.DEFINE_string('weights_out',None,'output file for weights')
     flags.DEFINE_boolean('rescore',True,'True: do rescoring during bottom-up search; False: use only scores at initialization to determine 1best. Default: True')
+    flags.DEFINE_boolean('cubegrowing',False,'Decode by cube growing: fill nonterminal cells on demand from the root instead of bottom-up to k. Default: False')
+    flags.DEFINE_float('kperword',None,'Span-dependent beam size: a nonterminal spanning n e words keeps min(k, ceil(kperword*n)) items. Default: None (k items everywhere)')
+    flags.DEFINE_float('beam_margin',None,'Relative beam threshold: drop items scoring more than this margin below the best item in their cell. Applied together with the beam size limits --k and --init_k. Default: None (fixed-size beams only)')
+    flags.DEFINE_integer('coarsetofine',None,'Coarse-to-fine search: first search without nonlocal features, then search with the full model only over preterminal hypotheses that reached the top N items of some cell. Default: None (single pass)')
+    flags.DEFINE_string('binarize',None,'Binarize n-ary nodes of the e trees before search. one of {none, left, right, head}; default: None (use trees as given)')
+    flags.DEFINE_integer('candidates',None,'Candidate index: each e word only considers its N best f positions by p(e|f)+p(f|e), plus f positions linked in --a1/--a2/--inverse and within --band of the diagonal. Default: None (all f positions)')
+    flags.DEFINE_integer('band',0,'Diagonal band width for --candidates: also consider f positions within this distance of the diagonal. Default: 0')
+    flags.DEFINE_integer('chunkminlength',None,'Split sentence pairs with at least this many words on either side into chunks at anchor points (one-to-one --a1 links and identical punctuation); e words then only link into the f window of their chunk. Default: None (no chunking)')
+    flags.DEFINE_integer('chunkslack',2,'Widen chunk windows by this many f words on both sides. Default: 2')
+    flags.DEFINE_integer('maxlinkgap',None,'Maximum distance between the f positions of two links to the same e word. Default: None (no limit), or 1 with --langpair ar_en')
+    flags.DEFINE_boolean('boundpruning',False,'Skip building cube neighbors that upper bounds on nonlocal feature scores show can never enter the beam. Does not change the search result. Default: False')
+    flags.DEFINE_integer('subtreeprocs',None,'Align disjoint subtrees of long sentences in a local pool of this many processes. Not used with --cubegrowing, --coarsetofine or --rescore false. Default: None (serial search)')
+    flags.DEFINE_integer('subtreeminlength',50,'Minimum e sentence length for --subtreeprocs. Default: 50')
+    flags.DEFINE_float('timebudget',None,'Per-sentence search time budget in seconds. When exceeded, search again with a quarter of the beam size, and then with local features only. Default: None (no limit)')
+    flags.DEFINE_integer('edgebudget',None,'Per-sentence budget on the number of hyperedges created, with the same fallbacks as --timebudget. Default: None (no limit)')
+    flags.DEFINE_boolean('linkbits',False,'Represent the links of each hypothesis as an integer bitmask over the f x e grid. Makes the F-score of hypotheses during training a popcount. Default: False')
+    flags.DEFINE_boolean('keepbeams',False,'Keep the full cells of all nodes until a sentence is done. By default, a cell is cut down to its best item once its parent cell is built. Default: False')
+    flags.DEFINE_boolean('cacheoracle',False,'With --oracle gold, keep the gold oracle of each training sentence in tmpdir after the first epoch and skip searching for it in later epochs. Only oracles that cannot depend on the weights are kept, which needs at most 10 candidate f positions per e word (see --candidates); other sentences search for their oracle in every epoch. Default: False')
+    flags.DEFINE_boolean('lazy',False,'Lazy cube pruning: rank cube neighbors by the sum of their child scores; build and rescore only edges that are popped. Default: False')
     flags.DEFINE_boolean('train', False, 'Run discriminative training')
     flags.DEFINE_boolean('align', False, 'Align data with parameters from --weights')
     flags.DEFINE_boolean('decodeheldout',True,'Align heldout data with new weight vector after each epoch.')
@@ -722,6 +832,14 @@ if __name__ == "__main__":
     localFeatures = Features.LocalFeatures(pef, pfe)
     nonlocalFeatures = Features.NonlocalFeatures(pef, pfe)
 
+    ########################################################
+    # Fork the subtree process pool, once for the whole run
+    ########################################################
+    subtreePool = None
+    if FLAGS.subtreeprocs is not None:
+      subtreePool = GridAlign.SubtreePool(FLAGS.subtreeprocs, localFeatures,
+                                          nonlocalFeatures, pef, pfe, FLAGS)
+
     e_instances = []
     f_instances = []
     etree_instances = []
@@ -730,6 +848,7 @@ if __name__ == "__main__":
     a2_instances = []
     gold_instances = []
     inverse_instances = []
+    constraints_instances = []
 
     if FLAGS.train:
       f_dev_instances = []
@@ -740,6 +859,7 @@ if __name__ == "__main__":
       a2_dev_instances = []
       gold_dev_instances = []
       inverse_dev_instances = []
+      constraints_dev_instances = []
 
     tmpdir = None
     if mpi.rank == 0:
@@ -803,6 +923,7 @@ if __name__ == "__main__":
       'pfe': pfe,
       'localFeatures': localFeatures,
       'nonlocalFeatures': nonlocalFeatures,
+      'subtreePool': subtreePool,
       'tmpdir': tmpdir
     }
     training_blob = {
@@ -813,7 +934,8 @@ if __name__ == "__main__":
       'gold_instances': None,
       'a1_instances': None,
       'a2_instances': None,
-      'inverse_instances': None
+      'inverse_instances': None,
+      'constraints_instances': None
     }
 
     if FLAGS.ftrees is not None:
@@ -826,6 +948,8 @@ if __name__ == "__main__":
       training_blob['a2_instances'] = file_handles['a2']
     if FLAGS.inverse is not None:
       training_blob['inverse_instances'] = file_handles['inverse']
+    if FLAGS.constraints is not None:
+      training_blob['constraints_instances'] = file_handles['constraints']
 
     if FLAGS.train:
       heldout_blob = {
@@ -836,7 +960,8 @@ if __name__ == "__main__":
       'gold_instances': file_handles['golddev'],
       'a1_instances': None,
       'a2_instances': None,
-      'inverse_instances': None
+      'inverse_instances': None,
+      'constraints_instances': None
       }
 
       if FLAGS.ftrees is not None:
@@ -847,6 +972,8 @@ if __name__ == "__main__":
         heldout_blob['a2_instances'] = file_handles['a2_dev']
       if FLAGS.inverse is not None:
         heldout_blob['inverse_instances'] = file_handles['inverse_dev']
+      if FLAGS.constraints_dev is not None:
+        heldout_blob['constraints_instances'] = file_handles['constraints_dev']
 
 
     training_blob.update(common_blob)
@@ -858,3 +985,5 @@ if __name__ == "__main__":
     elif FLAGS.align:
       decode_parallel(weights, indices, training_blob, "align",
                       out=file_handles['out'])
+    if subtreePool is not None:
+      subtreePool.close()